@@ -0,0 +1,849 @@
+'''
+Benchmarks
+----------------------------
+Times the force engines against the original per-object path.
+
+Usage:
+    python3 benchmark.py direct [N ...]
+    python3 benchmark.py barnes-hut [N ...]
+    python3 benchmark.py particle-mesh [N ...]
+    python3 benchmark.py p3m [N ...]
+    python3 benchmark.py fmm [N ...]
+    python3 benchmark.py pairs [N ...]
+    python3 benchmark.py trig [N ...]
+    python3 benchmark.py memory [N ...]
+    python3 benchmark.py collisions [N ...]
+    python3 benchmark.py merging [N ...]
+    python3 benchmark.py integrators [N ...]
+    python3 benchmark.py adaptive [N ...]
+    python3 benchmark.py block [N ...]
+    python3 benchmark.py hermite [N ...]
+    python3 benchmark.py softening [N ...]
+    python3 benchmark.py jit [N ...]
+    python3 benchmark.py parallel [N ...]
+    python3 benchmark.py threaded [N ...]
+    python3 benchmark.py blocking [N ...]
+    python3 benchmark.py precision [N ...]
+    python3 benchmark.py workspace [N ...]
+'''
+import copy
+import gc
+import math
+import os
+import random
+import sys
+import time
+import tracemalloc
+
+import numpy as np
+
+import kernels
+from body import GRAV_CONST, Object
+from collisions import SpatialHash, SweepAndPrune
+from engines import BarnesHutEngine, DirectEngine, FastMultipoleEngine, P3MEngine, ParallelEngine, ParticleMeshEngine, ThreadedEngine
+from integrators import AdaptiveTimestep, BlockTimestepIntegrator, EulerIntegrator, HermiteIntegrator, LeapfrogIntegrator
+from particles import ARRAYS, ParticleSet
+
+size = (1280, 720)
+start_mass = 50
+
+# The force path Object used before it went trig-free, kept to compare against
+class TrigObject(Object):
+    def calculate_new_velocity(self, obj, grav_const=GRAV_CONST):
+        angle = self.calculate_angle(obj)
+        force = self.calculate_force_magnitude(obj, grav_const)
+        force_x = force * math.cos(angle)
+        force_y = force * math.sin(angle)
+        self.store_force_x += force_x
+        self.store_force_y += force_y
+        self.acceleration_x = force_x / self.mass
+        self.acceleration_y = force_y / self.mass
+        self.velocity_x += self.acceleration_x
+        self.velocity_y += self.acceleration_y
+
+    def calculate_angle(self, obj):
+        return math.atan2(obj.position_y - self.position_y, obj.position_x - self.position_x)
+
+    def calculate_force_magnitude(self, obj, grav_const):
+        distance = math.sqrt((self.position_x - obj.position_x)**2 + (self.position_y - obj.position_y)**2)
+        return grav_const * (self.mass * obj.mass)/ (distance**2)
+
+def random_objects(number_of_objects, seed=0, kind=Object):
+    # Same setup as init_objects() in main.py
+    # Positions are kept unique, since the per-object path divides by zero
+    # for two bodies on the same spot (main.py merges those before gravity)
+    rng = random.Random(seed)
+    objects = []
+    taken = set()
+    for i in range(number_of_objects):
+        mass = start_mass * (10 ** 11)
+        position_x = rng.randint(0, size[0])
+        position_y = rng.randint(0, size[1])
+        while (position_x, position_y) in taken:
+            position_x = rng.randint(0, size[0])
+            position_y = rng.randint(0, size[1])
+        taken.add((position_x, position_y))
+        color = (rng.randint(0, 255), rng.randint(0, 255), rng.randint(0, 255))
+        objects.append(kind(mass, position_x, position_y, color))
+        objects[i].calculate_radius()
+    return objects
+
+def object_step(objects):
+    # The force loop main.py used to run every substep
+    for x in objects:
+        for y in objects:
+            if x != y and not x.merged and not y.merged:
+                x.calculate_new_velocity(y)
+
+def object_step_symmetric(objects):
+    # Each unordered pair once, pulling both ways (Newton's third law)
+    live = [x for x in objects if not x.merged]
+    for i, x in enumerate(live):
+        for y in live[i + 1:]:
+            x.attract(y)
+
+def timed(function, *args):
+    start = time.perf_counter()
+    function(*args)
+    return time.perf_counter() - start
+
+def velocities(objects):
+    return np.array([[x.velocity_x, x.velocity_y] for x in objects])
+
+def max_relative_error(result, reference):
+    scale = np.abs(reference).max()
+    return np.abs(result - reference).max() / scale
+
+def bench_direct(sizes):
+    engine = DirectEngine()
+    # Loads any compiled kernels the engine uses before it is timed
+    engine.accelerations(*random_arrays(10), GRAV_CONST)
+    print("%8s %14s %14s %10s %12s" % ("N", "object (s)", "direct (s)", "speedup", "max rel err"))
+    for n in sizes:
+        reference = random_objects(n)
+        particles = ParticleSet.from_objects(reference)
+        object_time = timed(object_step, reference)
+        direct_time = timed(particles.apply_gravity, engine, GRAV_CONST)
+        result = np.stack([particles.velocity_x, particles.velocity_y], axis=1)
+        error = max_relative_error(result, velocities(reference))
+        print("%8d %14.4f %14.4f %9.1fx %12.2e" % (n, object_time, direct_time, object_time / direct_time, error))
+
+def random_arrays(number, seed=0):
+    # Positions, masses the way init_objects() makes them, as arrays
+    rng = np.random.default_rng(seed)
+    position_x = rng.uniform(0, size[0], number)
+    position_y = rng.uniform(0, size[1], number)
+    mass = np.full(number, start_mass * 10.0 ** 11)
+    return position_x, position_y, mass
+
+def exact_sample(position_x, position_y, mass, sample):
+    # Direct sum for a few target bodies only, so large N stays affordable
+    acceleration = np.zeros((len(sample), 2))
+    for row, i in enumerate(sample):
+        diff_x = position_x - position_x[i]
+        diff_y = position_y - position_y[i]
+        distance_sq = diff_x ** 2 + diff_y ** 2
+        distance_sq[distance_sq == 0] = np.inf
+        strength = GRAV_CONST * mass / (distance_sq * np.sqrt(distance_sq))
+        acceleration[row] = (strength * diff_x).sum(), (strength * diff_y).sum()
+    return acceleration
+
+def accuracy(acceleration_x, acceleration_y, reference, sample):
+    # Relative error of the acceleration vector on each sampled body
+    result = np.stack([acceleration_x[sample], acceleration_y[sample]], axis=1)
+    error = np.hypot(*(result - reference).T) / np.hypot(*reference.T)
+    return np.median(error), np.percentile(error, 99), error.max()
+
+def bench_engine_accuracy(sizes, engines):
+    print("%8s %-22s %10s %12s %12s %12s" % ("N", "engine", "time (s)", "median err", "99% err", "max err"))
+    for n in sizes:
+        position_x, position_y, mass = random_arrays(n)
+        sample = np.random.default_rng(1).choice(n, min(n, 500), replace=False)
+        reference = exact_sample(position_x, position_y, mass, sample)
+        for label, engine in engines:
+            # Loads any compiled kernels the engine uses before it is timed
+            engine.accelerations(*random_arrays(10), GRAV_CONST)
+            start = time.perf_counter()
+            acceleration_x, acceleration_y = engine.accelerations(position_x, position_y, mass, GRAV_CONST)
+            elapsed = time.perf_counter() - start
+            errors = accuracy(acceleration_x, acceleration_y, reference, sample)
+            print("%8d %-22s %10.4f %12.2e %12.2e %12.2e" % ((n, label, elapsed) + errors))
+
+def bench_barnes_hut(sizes):
+    engines = [("barnes-hut theta=%g" % theta, BarnesHutEngine(theta)) for theta in (0.3, 0.5, 0.8)]
+    bench_engine_accuracy(sizes, engines)
+
+def bench_outlier(engines, n=3000):
+    # n bodies on screen plus one flung far away (border off): time per step
+    # and median error of the pull on the bodies on screen
+    print()
+    print("%12s %-22s %10s %12s" % ("outlier (m)", "engine", "time (s)", "median err"))
+    position_x, position_y, mass = random_arrays(n)
+    sample = np.random.default_rng(1).choice(n, 500, replace=False)
+    for distance in (None, 2 * 10 ** 4, 2 * 10 ** 5):
+        if distance is not None:
+            position_x, position_y, mass = random_arrays(n)
+            position_x = np.append(position_x, size[0] / 2 + distance)
+            position_y = np.append(position_y, size[1] / 2)
+            mass = np.append(mass, start_mass * 10.0 ** 11)
+        reference = exact_sample(position_x, position_y, mass, sample)
+        for label, engine in engines:
+            engine.accelerations(position_x, position_y, mass, GRAV_CONST)
+            start = time.perf_counter()
+            acceleration_x, acceleration_y = engine.accelerations(position_x, position_y, mass, GRAV_CONST)
+            elapsed = time.perf_counter() - start
+            median = accuracy(acceleration_x, acceleration_y, reference, sample)[0]
+            print("%12s %-22s %10.4f %12.2e" % ("none" if distance is None else distance, label, elapsed, median))
+
+def bench_particle_mesh(sizes):
+    engines = [("particle-mesh grid=%d" % grid, ParticleMeshEngine(size, grid)) for grid in (128, 256, 512)]
+    bench_engine_accuracy(sizes, engines)
+    bench_outlier(engines[1:2])
+
+def bench_p3m(sizes):
+    engines = [("particle-mesh grid=256", ParticleMeshEngine(size, 256))]
+    engines += [("p3m grid=256 cutoff=%d" % cutoff, P3MEngine(size, 256, cutoff)) for cutoff in (5, 8, 12)]
+    bench_engine_accuracy(sizes, engines)
+
+    # Pairs inside the cutoff, at random angles and places on the grid (one
+    # pair in each of 60 patches of the world): worst error of the pull on a
+    # body relative to its partner's pull, against the bound in the README
+    print()
+    print("%10s %8s %14s %8s %6s" % ("distance", "cells", "worst rel err", "bound", "ok"))
+    engine = P3MEngine(size, 256)
+    spacing = engine.mesh()[2]
+    rng = np.random.default_rng(2)
+    patch_x, patch_y = np.meshgrid(np.linspace(80, size[0] - 80, 10), np.linspace(80, size[1] - 80, 6))
+    patch_x, patch_y = patch_x.ravel(), patch_y.ravel()
+    pair_mass = start_mass * 10.0 ** 11
+    for cells in (0.1, 0.5, 1, 2, 3, engine.cutoff / 2):
+        distance = cells * spacing
+        bound = 0.005 if cells <= 2 else 0.015
+        worst = 0.0
+        for repeat in range(8):
+            angle = rng.uniform(0, 2 * np.pi, len(patch_x))
+            first_x = patch_x + rng.uniform(0, spacing, len(patch_x))
+            first_y = patch_y + rng.uniform(0, spacing, len(patch_y))
+            position_x = np.concatenate([first_x, first_x + distance * np.cos(angle)])
+            position_y = np.concatenate([first_y, first_y + distance * np.sin(angle)])
+            mass = np.full(len(position_x), pair_mass)
+            exact = DirectEngine().accelerations(position_x, position_y, mass, GRAV_CONST)
+            result = engine.accelerations(position_x, position_y, mass, GRAV_CONST)
+            error = np.hypot(result[0] - exact[0], result[1] - exact[1]).max()
+            worst = max(worst, error / (GRAV_CONST * pair_mass / distance ** 2))
+        print("%10.2f %8g %14.2e %7g%% %6s" % (distance, cells, worst, 100 * bound, worst <= bound))
+
+def bench_fmm(sizes):
+    engines = [("fmm order=%d" % order, FastMultipoleEngine(order)) for order in (4, 6, 10)]
+    engines.append(("barnes-hut theta=0.5", BarnesHutEngine(0.5)))
+    bench_engine_accuracy(sizes, engines)
+
+    # Crossover: first N where each fmm order is faster than direct / barnes-hut
+    print()
+    print("%8s %12s %22s %12s %12s %12s" % ("N", "direct (s)", "barnes-hut theta=0.5", "fmm 4", "fmm 6", "fmm 10"))
+    crossover = {}
+    # Blocked (or compiled), so it is timed at every size
+    direct = DirectEngine()
+    direct.accelerations(*random_arrays(10), GRAV_CONST)
+    for n in sizes:
+        position_x, position_y, mass = random_arrays(n)
+        times = [timed(direct.accelerations, position_x, position_y, mass, GRAV_CONST)]
+        for label, engine in engines[-1:] + engines[:-1]:
+            engine.accelerations(position_x, position_y, mass, GRAV_CONST)
+            times.append(timed(engine.accelerations, position_x, position_y, mass, GRAV_CONST))
+        print("%8d %12.4f %22.4f %12.4f %12.4f %12.4f" % ((n,) + tuple(times)))
+        for column, order in enumerate((4, 6, 10)):
+            fmm_time = times[2 + column]
+            for rival, rival_time in (("direct", times[0]), ("barnes-hut", times[1])):
+                if fmm_time < rival_time and (order, rival) not in crossover:
+                    crossover[order, rival] = n
+    print()
+    for order in (4, 6, 10):
+        for rival in ("direct", "barnes-hut"):
+            print("fmm order %2d beats %-10s from N = %s" % (order, rival, crossover.get((order, rival), "never (in these sizes)")))
+
+def bench_pairs(sizes):
+    # Per-object path: every ordered pair vs every unordered pair once
+    print("%8s %16s %16s %10s %14s" % ("N", "both ways (s)", "symmetric (s)", "speedup", "bit-identical"))
+    for n in sizes:
+        if n > 5000:
+            continue
+        # Best of three on fresh copies, a single pure python run is noisy
+        both_time = symmetric_time = float("inf")
+        for repeat in range(3):
+            objects = random_objects(n)
+            reference = random_objects(n)
+            both_time = min(both_time, timed(object_step, reference))
+            symmetric_time = min(symmetric_time, timed(object_step_symmetric, objects))
+        same = np.array_equal(velocities(objects), velocities(reference))
+        print("%8d %16.4f %16.4f %9.1fx %14s" % (n, both_time, symmetric_time, both_time / symmetric_time, same))
+
+    # Pair sums inside p3m and fmm, in deterministic mode both ways must agree to the bit
+    print()
+    print("%8s %-6s %16s %16s %10s %14s" % ("N", "engine", "both ways (s)", "symmetric (s)", "speedup", "bit-identical"))
+    for n in sizes:
+        position_x, position_y, mass = random_arrays(n)
+        for label, make in (("p3m", lambda **flags: P3MEngine(size, 256, 5, **flags)), ("fmm", lambda **flags: FastMultipoleEngine(6, **flags))):
+            results = {}
+            times = {}
+            for symmetric in (False, True):
+                engine = make(symmetric=symmetric)
+                engine.accelerations(position_x, position_y, mass, GRAV_CONST)
+                times[symmetric] = timed(engine.accelerations, position_x, position_y, mass, GRAV_CONST)
+                engine.deterministic = True
+                results[symmetric] = engine.accelerations(position_x, position_y, mass, GRAV_CONST)
+            same = all(np.array_equal(a, b) for a, b in zip(results[False], results[True]))
+            print("%8d %-6s %16.4f %16.4f %9.1fx %14s" % (n, label, times[False], times[True], times[False] / times[True], same))
+
+def bench_trig(sizes):
+    # Micro-benchmark: one calculate_new_velocity call, angle + cos/sin vs vector components
+    pair = random_objects(2, kind=TrigObject)
+    trig_call = min(timeit_repeat(pair[0].calculate_new_velocity, pair[1]))
+    pair = random_objects(2)
+    vector_call = min(timeit_repeat(pair[0].calculate_new_velocity, pair[1]))
+    print("calculate_new_velocity: trig %.0f ns, trig-free %.0f ns per call (%.2fx)" % (trig_call * 1e9, vector_call * 1e9, trig_call / vector_call))
+
+    # The whole per-object force loop
+    print()
+    print("%8s %12s %14s %10s %12s" % ("N", "trig (s)", "trig-free (s)", "speedup", "max rel err"))
+    for n in sizes:
+        trig_time = vector_time = float("inf")
+        for repeat in range(3):
+            reference = random_objects(n, kind=TrigObject)
+            objects = random_objects(n)
+            trig_time = min(trig_time, timed(object_step, reference))
+            vector_time = min(vector_time, timed(object_step, objects))
+        error = max_relative_error(velocities(objects), velocities(reference))
+        print("%8d %12.4f %14.4f %9.2fx %12.2e" % (n, trig_time, vector_time, trig_time / vector_time, error))
+
+def timeit_repeat(function, *args, calls=100000, repeat=5):
+    # Seconds per call, for each of `repeat` runs of `calls` calls
+    results = []
+    for run in range(repeat):
+        start = time.perf_counter()
+        for call in range(calls):
+            function(*args)
+        results.append((time.perf_counter() - start) / calls)
+    return results
+
+def allocated(function, *args):
+    # Bytes still held by whatever function(*args) built
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    result = function(*args)
+    after = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    return after - before, result
+
+def peak_allocated(function, *args):
+    # Most bytes held at once while function(*args) ran
+    tracemalloc.start()
+    function(*args)
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return peak
+
+def bench_memory(sizes):
+    print("%8s %18s %18s %10s" % ("N", "Object list (B/body)", "ParticleSet (B/body)", "ratio"))
+    for n in sizes:
+        object_bytes, objects = allocated(random_objects, n)
+        particle_bytes, particles = allocated(ParticleSet, n)
+        print("%8d %20.0f %20.0f %9.1fx" % (n, object_bytes / n, particle_bytes / n, object_bytes / particle_bytes))
+
+def collision_cloud(n, label):
+    # random_objects() as a ParticleSet: "sparse" has few bodies touching,
+    # "clustered" has radii spread widely (a few heavy bodies among many
+    # light ones, as late in a run), "crowded" has most of them merging
+    particles = ParticleSet.from_objects(random_objects(n))
+    if label == "sparse":
+        particles.mass /= 50
+    elif label == "clustered":
+        particles.mass *= np.random.default_rng(0).lognormal(0, 2, n) / 50
+    else:
+        particles.mass *= 400
+    particles.calculate_radius()
+    return particles
+
+def bench_collisions(sizes):
+    # One collision pass: every pair, the spatial hash and sweep and prune
+    broad_phases = (("brute", None), ("grid", SpatialHash), ("sweep", SweepAndPrune))
+    print("%8s %-10s %8s %10s %10s %10s %6s" % ("N", "cloud", "merges", "brute (s)", "grid (s)", "sweep (s)", "same"))
+    for n in sizes:
+        for label in ("sparse", "clustered", "crowded"):
+            results = {}
+            times = {}
+            for name, broad_phase in broad_phases:
+                particles = collision_cloud(n, label)
+                if broad_phase is SweepAndPrune:
+                    broad_phase = SweepAndPrune()
+                times[name] = timed(particles.collide, broad_phase)
+                results[name] = particles
+            brute = results["brute"]
+            same = all(np.array_equal(getattr(brute, field), getattr(other, field))
+                       for other in results.values() for field in ("merged", "mass", "velocity_x", "velocity_y"))
+            print("%8d %-10s %8d %10.4f %10.4f %10.4f %6s" % (n, label, np.count_nonzero(brute.merged), times["brute"], times["grid"], times["sweep"], same))
+
+    # Sweep and prune keeps its order between steps: re-sorting last step's
+    # order against sorting from scratch, over a few steps of a moving cloud
+    print()
+    print("%8s %18s %18s %10s" % ("N", "from scratch (ms)", "incremental (ms)", "speedup"))
+    for n in sizes:
+        particles = collision_cloud(n, "sparse")
+        rng = np.random.default_rng(1)
+        particles.velocity_x[:] = rng.normal(0, 0.5, n)
+        particles.velocity_y[:] = rng.normal(0, 0.5, n)
+        sweep = SweepAndPrune()
+        sweep(particles)
+        scratch_time = incremental_time = 0
+        for step in range(10):
+            particles.calculate_new_position(True, size)
+            scratch_time += timed(SweepAndPrune(), particles)
+            incremental_time += timed(sweep, particles)
+        print("%8d %18.3f %18.3f %9.1fx" % (n, scratch_time * 100, incremental_time * 100, scratch_time / incremental_time))
+
+def bench_merging(sizes):
+    # Pair by pair merging against union-find clusters (both with the
+    # spatial hash), and whether clusters give the same result when the
+    # bodies come in a shuffled order
+    print("%8s %-10s %10s %10s %12s %14s %14s %12s" % ("N", "cloud", "pairs (s)", "left", "clusters (s)", "left", "momentum err", "any order"))
+    # Loads the compiled grid pass (with numba) before anything is timed
+    collision_cloud(10, "clustered").collide_clusters(SpatialHash)
+    for n in sizes:
+        for label in ("sparse", "clustered", "crowded"):
+            particles = collision_cloud(n, label)
+            particles.velocity_x[:] = np.random.default_rng(1).normal(0, 1, n)
+            pairs = copy.deepcopy(particles)
+            clusters = copy.deepcopy(particles)
+            pairs_time = timed(pairs.collide, SpatialHash)
+            clusters_time = timed(clusters.collide_clusters, SpatialHash)
+            momentum = np.sum(particles.mass * particles.velocity_x)
+            live = ~clusters.merged
+            error = abs(np.sum(clusters.mass[live] * clusters.velocity_x[live]) - momentum) / abs(momentum)
+
+            shuffle = np.random.default_rng(2).permutation(n)
+            shuffled = copy.deepcopy(particles)
+            for name in ARRAYS:
+                setattr(shuffled, name, getattr(shuffled, name)[shuffle])
+            shuffled.collide_clusters(SpatialHash)
+            back = np.argsort(shuffle)
+            same = all(np.array_equal(getattr(shuffled, name)[back], getattr(clusters, name)) for name in ("merged", "mass", "velocity_x"))
+            print("%8d %-10s %10.4f %10d %12.4f %14d %14.1e %12s" % (n, label, pairs_time, np.count_nonzero(~pairs.merged), clusters_time,
+                                                                   np.count_nonzero(live), error, same))
+
+def orbit_system(n, seed=0, eccentric=False):
+    # A heavy body in the middle of the screen with n light ones on circular
+    # orbits 100 to 300 m out (periods of about 50 to 300 s). The light ones
+    # barely pull on each other, so close passes between them don't matter.
+    # eccentric starts them 400 to 600 m out at 45% of the circular speed
+    # instead, so they swing in to about 50 m and out again every 200-300 s
+    rng = np.random.default_rng(seed)
+    particles = ParticleSet(n + 1)
+    particles.mass[0] = 2000 * 10 ** 11
+    particles.mass[1:] = 10 ** 6
+    distance = rng.uniform(400, 600, n) if eccentric else rng.uniform(100, 300, n)
+    angle = rng.uniform(0, 2 * np.pi, n)
+    speed = np.sqrt(GRAV_CONST * particles.mass[0] / distance)
+    if eccentric:
+        speed *= 0.45
+    particles.position_x[:] = size[0] / 2
+    particles.position_y[:] = size[1] / 2
+    particles.position_x[1:] += distance * np.cos(angle)
+    particles.position_y[1:] += distance * np.sin(angle)
+    particles.velocity_x[1:] = -speed * np.sin(angle)
+    particles.velocity_y[1:] = speed * np.cos(angle)
+    particles.calculate_radius()
+    return particles
+
+def energy_drift(integrator, particles, dt, duration, timestep=None, engine=None):
+    # Largest relative change of the total energy over `duration` seconds,
+    # the number of steps taken and the wall time they took. With a timestep
+    # (AdaptiveTimestep) dt is picked before every step instead
+    engine = engine or DirectEngine()
+    softening = engine.softening
+    start = particles.total_energy(GRAV_CONST, softening)
+    drift = 0.0
+    steps = 0
+    elapsed = 0.0
+    simulated = 0.0
+    while simulated < duration - 1e-9:
+        if timestep is not None:
+            begin = time.perf_counter()
+            dt = timestep.choose(particles, GRAV_CONST)
+            elapsed += time.perf_counter() - begin
+        dt = min(dt, duration - simulated)
+        elapsed += timed(integrator.step, particles, engine, GRAV_CONST, dt, False, size)
+        simulated += dt
+        steps += 1
+        if steps % 20 == 0:
+            drift = max(drift, abs(particles.total_energy(GRAV_CONST, softening) - start) / abs(start))
+    drift = max(drift, abs(particles.total_energy(GRAV_CONST, softening) - start) / abs(start))
+    return drift, steps, elapsed
+
+def bench_integrators(sizes):
+    # Energy drift of light bodies orbiting a heavy one over 2000 s (several
+    # orbits), for Euler and leapfrog at a few step sizes
+    duration = 2000
+    print("%8s %-10s %6s %8s %14s %10s" % ("N", "integrator", "dt", "steps", "energy drift", "wall (s)"))
+    for n in sizes:
+        for integrator, steps in ((EulerIntegrator, (0.25, 0.5, 1)), (LeapfrogIntegrator, (1, 2.5, 5, 10))):
+            for dt in steps:
+                drift, count, elapsed = energy_drift(integrator(), orbit_system(n), dt, duration)
+                print("%8d %-10s %6g %8d %14.2e %10.3f" % (n, integrator.name, dt, count, drift, elapsed))
+
+def bench_adaptive(sizes):
+    # Eccentric orbits that swing in close to the heavy body: fixed steps
+    # against steps picked by AdaptiveTimestep (at most 5 s) over 2000 s
+    duration = 2000
+    print("%8s %-10s %-14s %8s %14s %10s" % ("N", "integrator", "dt", "steps", "energy drift", "wall (s)"))
+    for n in sizes:
+        for integrator in (EulerIntegrator, LeapfrogIntegrator):
+            for dt in (1, 0.25):
+                drift, steps, elapsed = energy_drift(integrator(), orbit_system(n, eccentric=True), dt, duration)
+                print("%8d %-10s %-14s %8d %14.2e %10.3f" % (n, integrator.name, "fixed %g" % dt, steps, drift, elapsed))
+            for accuracy in (0.1, 0.03):
+                timestep = AdaptiveTimestep(5, accuracy)
+                drift, steps, elapsed = energy_drift(integrator(), orbit_system(n, eccentric=True), 5, duration, timestep)
+                print("%8d %-10s %-14s %8d %14.2e %10.3f" % (n, integrator.name, "adaptive %g" % accuracy, steps, drift, elapsed))
+
+def wide_system(n, seed=0):
+    # A tight pair of heavy bodies (60 m apart, 25 s orbit) in the middle,
+    # with n light bodies on wide circular orbits 200 to 600 m out
+    rng = np.random.default_rng(seed)
+    particles = ParticleSet(n + 2)
+    particles.mass[:2] = 1000 * 10 ** 11
+    particles.mass[2:] = 10 ** 6
+    center_x = size[0] / 2
+    center_y = size[1] / 2
+    speed = np.sqrt(GRAV_CONST * 2 * particles.mass[0] / 60) / 2
+    particles.position_x[:2] = center_x - 30, center_x + 30
+    particles.position_y[:2] = center_y
+    particles.velocity_y[:2] = -speed, speed
+    distance = rng.uniform(200, 600, n)
+    angle = rng.uniform(0, 2 * np.pi, n)
+    speed = np.sqrt(GRAV_CONST * 2 * particles.mass[0] / distance)
+    particles.position_x[2:] = center_x + distance * np.cos(angle)
+    particles.position_y[2:] = center_y + distance * np.sin(angle)
+    particles.velocity_x[2:] = -speed * np.sin(angle)
+    particles.velocity_y[2:] = speed * np.cos(angle)
+    particles.calculate_radius()
+    return particles
+
+def bench_block(sizes):
+    # Block timesteps against one adaptive dt for everyone, on a tight pair
+    # with light bodies far around it, over 500 s in steps of at most 5 s.
+    # Error is the furthest any body ends up from a leapfrog run with dt = 0.02
+    duration = 500
+    engine = DirectEngine()
+    print("%8s %-16s %12s %12s %14s %10s" % ("N", "integrator", "evaluations", "error (m)", "energy drift", "wall (s)"))
+    for n in sizes:
+        reference = wide_system(n)
+        integrator = LeapfrogIntegrator()
+        for step in range(int(duration / 0.02)):
+            integrator.step(reference, engine, GRAV_CONST, 0.02, False, size)
+
+        for accuracy in (0.1, 0.03):
+            particles = wide_system(n)
+            start = particles.total_energy(GRAV_CONST)
+            timestep = AdaptiveTimestep(5, accuracy)
+            integrator = LeapfrogIntegrator()
+            simulated = 0.0
+            steps = 0
+            begin = time.perf_counter()
+            while simulated < duration - 1e-9:
+                dt = min(timestep.choose(particles, GRAV_CONST), duration - simulated)
+                integrator.step(particles, engine, GRAV_CONST, dt, False, size)
+                simulated += dt
+                steps += 1
+            elapsed = time.perf_counter() - begin
+            error = np.max(np.hypot(particles.position_x - reference.position_x, particles.position_y - reference.position_y))
+            drift = abs(particles.total_energy(GRAV_CONST) - start) / abs(start)
+            print("%8d %-16s %12d %12.3g %14.2e %10.3f" % (n, "global %g" % accuracy, steps * len(particles), error, drift, elapsed))
+
+            particles = wide_system(n)
+            integrator = BlockTimestepIntegrator(accuracy)
+            begin = time.perf_counter()
+            for step in range(int(duration / 5)):
+                integrator.step(particles, engine, GRAV_CONST, 5, False, size)
+            elapsed = time.perf_counter() - begin
+            error = np.max(np.hypot(particles.position_x - reference.position_x, particles.position_y - reference.position_y))
+            drift = abs(particles.total_energy(GRAV_CONST) - start) / abs(start)
+            print("%8d %-16s %12d %12.3g %14.2e %10.3f" % (n, "block %g" % accuracy, integrator.evaluations, error, drift, elapsed))
+
+def bench_hermite(sizes):
+    # Energy error against wall time on the eccentric orbits over 2000 s, for
+    # Euler, leapfrog and Hermite at a few fixed step sizes, then leapfrog and
+    # Hermite with AdaptiveTimestep (at most 5 s). Hermite works out the
+    # forces twice per step, so compare at equal wall time, not equal dt
+    duration = 2000
+    print("%8s %-10s %-14s %8s %14s %10s" % ("N", "integrator", "dt", "steps", "energy drift", "wall (s)"))
+    for n in sizes:
+        for integrator, steps in ((EulerIntegrator, (0.25, 1)), (LeapfrogIntegrator, (0.1, 0.25, 1)),
+                                  (HermiteIntegrator, (0.25, 0.5, 1))):
+            for dt in steps:
+                drift, count, elapsed = energy_drift(integrator(), orbit_system(n, eccentric=True), dt, duration)
+                print("%8d %-10s %-14s %8d %14.2e %10.3f" % (n, integrator.name, "fixed %g" % dt, count, drift, elapsed))
+        for integrator in (LeapfrogIntegrator, HermiteIntegrator):
+            for accuracy in (0.1, 0.03):
+                timestep = AdaptiveTimestep(5, accuracy)
+                drift, count, elapsed = energy_drift(integrator(), orbit_system(n, eccentric=True), 5, duration, timestep)
+                print("%8d %-10s %-14s %8d %14.2e %10.3f" % (n, integrator.name, "adaptive %g" % accuracy, count, drift, elapsed))
+
+def bench_softening(sizes):
+    # A cold cloud of random_objects() falling in on itself for 300 s, without
+    # collisions (point bodies), so close encounters go on without merging.
+    # Leapfrog with AdaptiveTimestep (at most 5 s), for a few softening
+    # lengths and acceleration caps. Energy drift is of the softened energy;
+    # a cap doesn't conserve energy, so there it only shows the run stayed sane
+    duration = 300
+    print("%8s %10s %10s %8s %10s %14s %10s" % ("N", "softening", "max acc", "steps", "mean dt", "energy drift", "wall (s)"))
+    for n in sizes:
+        for softening, max_acceleration in ((0, None), (2, None), (5, None), (10, None), (0, 2.0), (0, 0.5), (5, 0.5)):
+            particles = ParticleSet.from_objects(random_objects(n))
+            particles.radius[:] = 0
+            timestep = AdaptiveTimestep(5, 0.1, softening=softening, max_acceleration=max_acceleration)
+            engine = DirectEngine(softening, max_acceleration)
+            drift, steps, elapsed = energy_drift(LeapfrogIntegrator(), particles, 5, duration, timestep, engine)
+            print("%8d %10g %10s %8d %10.3g %14.2e %10.3f" % (n, softening, max_acceleration or "-", steps, duration / steps, drift, elapsed))
+
+def bench_jit(sizes):
+    # The numba kernels against the numpy code they replace: direct sum
+    # gravity and one brute force collision pass over the "sparse" cloud
+    if not kernels.enabled:
+        print("numba is not installed, nothing to compare")
+        return
+    # Compiles (or loads from the disk cache) before timing
+    particles = collision_cloud(10, "sparse")
+    particles.collide_rows()
+    DirectEngine().accelerations(particles.position_x, particles.position_y, particles.mass, GRAV_CONST)
+
+    print("%8s %-10s %12s %12s %10s %6s" % ("N", "kernel", "numpy (s)", "numba (s)", "speedup", "same"))
+    for n in sizes:
+        position_x, position_y, mass = random_arrays(n)
+        times = {}
+        results = {}
+        for compiled in (False, True):
+            kernels.enabled = compiled
+            results[compiled] = DirectEngine().accelerations(position_x, position_y, mass, GRAV_CONST)
+            times[compiled] = timed(DirectEngine().accelerations, position_x, position_y, mass, GRAV_CONST)
+        same = max(max_relative_error(a, b) for a, b in zip(results[True], results[False])) < 1e-12
+        print("%8d %-10s %12.4f %12.4f %9.1fx %6s" % (n, "direct", times[False], times[True], times[False] / times[True], same))
+
+        for compiled in (False, True):
+            kernels.enabled = compiled
+            results[compiled] = collision_cloud(n, "sparse")
+            times[compiled] = timed(results[compiled].collide_rows)
+        same = all(np.array_equal(getattr(results[True], name), getattr(results[False], name)) for name in ARRAYS)
+        print("%8d %-10s %12.4f %12.4f %9.1fx %6s" % (n, "collisions", times[False], times[True], times[False] / times[True], same))
+    kernels.enabled = True
+
+def worker_counts():
+    # 1, 2, 4, ... up to the number of cores (and that number itself)
+    cores = os.cpu_count() or 1
+    print("%d cores, numba %s" % (cores, "on" if kernels.enabled else "off"))
+    return sorted({2 ** power for power in range(cores.bit_length()) if 2 ** power <= cores} | {cores})
+
+def bench_parallel(sizes):
+    # Strong scaling of ParallelEngine: the same N on 1, 2, 4, ... workers
+    # (up to the number of cores), best of three evaluations each. Speedup
+    # and efficiency are against one worker, "direct" is the plain engine.
+    # "same" checks the result is bit-identical to the one with one worker
+    counts = worker_counts()
+    print("%8s %8s %12s %12s %10s %11s %6s" % ("N", "workers", "direct (s)", "time (s)", "speedup", "efficiency", "same"))
+    for n in sizes:
+        position_x, position_y, mass = random_arrays(n)
+        direct_time = min(timed(DirectEngine().accelerations, position_x, position_y, mass, GRAV_CONST) for repeat in range(3))
+        single = None
+        for workers in counts:
+            engine = ParallelEngine(workers)
+            # The first call starts the pool
+            result = engine.accelerations(position_x, position_y, mass, GRAV_CONST)
+            elapsed = min(timed(engine.accelerations, position_x, position_y, mass, GRAV_CONST) for repeat in range(3))
+            engine.close()
+            if single is None:
+                single = elapsed
+                reference = result
+            same = all(np.array_equal(a, b) for a, b in zip(result, reference))
+            print("%8d %8d %12.4f %12.4f %9.2fx %10.0f%% %6s" % (n, workers, direct_time, elapsed, single / elapsed,
+                                                                 100 * single / elapsed / workers, same))
+
+def bench_threaded(sizes):
+    # Strong scaling of ThreadedEngine, as bench_parallel, with the process
+    # pool on every core for comparison. "same" checks the result is
+    # bit-identical to the one with one thread
+    counts = worker_counts()
+    print("%8s %-10s %8s %12s %12s %10s %11s %6s" % ("N", "engine", "workers", "direct (s)", "time (s)", "speedup", "efficiency", "same"))
+    for n in sizes:
+        position_x, position_y, mass = random_arrays(n)
+        direct_time = min(timed(DirectEngine().accelerations, position_x, position_y, mass, GRAV_CONST) for repeat in range(3))
+        single = None
+        for workers in counts:
+            engine = ThreadedEngine(workers)
+            result = engine.accelerations(position_x, position_y, mass, GRAV_CONST)
+            elapsed = min(timed(engine.accelerations, position_x, position_y, mass, GRAV_CONST) for repeat in range(3))
+            engine.close()
+            if single is None:
+                single = elapsed
+                reference = result
+            same = all(np.array_equal(a, b) for a, b in zip(result, reference))
+            print("%8d %-10s %8d %12.4f %12.4f %9.2fx %10.0f%% %6s" % (n, "threaded", workers, direct_time, elapsed, single / elapsed,
+                                                                       100 * single / elapsed / workers, same))
+        engine = ParallelEngine(counts[-1])
+        engine.accelerations(position_x, position_y, mass, GRAV_CONST)
+        elapsed = min(timed(engine.accelerations, position_x, position_y, mass, GRAV_CONST) for repeat in range(3))
+        engine.close()
+        print("%8d %-10s %8d %12.4f %12.4f %9.2fx %10.0f%% %6s" % (n, "parallel", counts[-1], direct_time, elapsed, single / elapsed,
+                                                                   100 * single / elapsed / counts[-1], "-"))
+
+def bench_blocking(sizes):
+    # The numpy direct sum (numba off) with the whole N x N matrix at once
+    # against blocks of 256 and 32 rows: best of three times, and the peak
+    # memory of a first call (scratch buffers included)
+    compiled = kernels.enabled
+    kernels.enabled = False
+    print("%8s %8s %10s %12s %10s" % ("N", "block", "time (s)", "peak (MB)", "speed"))
+    for n in sizes:
+        position_x, position_y, mass = random_arrays(n)
+        unblocked = None
+        for block in (n, 256, 32):
+            engine = DirectEngine()
+            engine.block = block
+            peak = peak_allocated(engine.accelerations, position_x, position_y, mass, GRAV_CONST)
+            elapsed = min(timed(engine.accelerations, position_x, position_y, mass, GRAV_CONST) for repeat in range(3))
+            unblocked = unblocked or elapsed
+            print("%8d %8s %10.4f %12.1f %9.2fx" % (n, "none" if block == n else block, elapsed, peak / 2 ** 20, unblocked / elapsed))
+    kernels.enabled = compiled
+
+def bench_precision(sizes):
+    # Single against double precision pair terms: time of each and the
+    # error of the single precision pull on every body (relative to the
+    # double one), for the direct engine with numpy and numba and for
+    # Barnes-Hut. Then how far 100 light bodies on orbits end up from the
+    # double precision run after 1000 s of leapfrog (dt = 1)
+    compiled = kernels.enabled
+    makers = [("direct", False, DirectEngine), ("barnes-hut", compiled, lambda precision: BarnesHutEngine(0.5, precision=precision))]
+    if compiled:
+        makers.insert(1, ("direct numba", True, DirectEngine))
+    print("%8s %-14s %11s %11s %9s %12s %12s %12s" % ("N", "engine", "double (s)", "single (s)", "speedup", "median err", "99% err", "max err"))
+    for n in sizes:
+        position_x, position_y, mass = random_arrays(n)
+        for label, numba, make in makers:
+            kernels.enabled = numba
+            times = {}
+            results = {}
+            for precision in ("double", "single"):
+                engine = make(precision=precision)
+                results[precision] = engine.accelerations(position_x, position_y, mass, GRAV_CONST)
+                times[precision] = min(timed(engine.accelerations, position_x, position_y, mass, GRAV_CONST) for repeat in range(3))
+            error = np.hypot(results["single"][0] - results["double"][0], results["single"][1] - results["double"][1]) / np.hypot(*results["double"])
+            print("%8d %-14s %11.4f %11.4f %8.2fx %12.2e %12.2e %12.2e" % (n, label, times["double"], times["single"], times["double"] / times["single"],
+                                                                          np.median(error), np.percentile(error, 99), error.max()))
+    kernels.enabled = compiled
+
+    print()
+    print("%-14s %16s %20s %20s" % ("engine", "max offset (m)", "drift (double)", "drift (single)"))
+    for label, numba, make in makers:
+        kernels.enabled = numba
+        runs = {}
+        drifts = {}
+        for precision in ("double", "single"):
+            runs[precision] = orbit_system(100)
+            drifts[precision] = energy_drift(LeapfrogIntegrator(), runs[precision], 1, 1000, engine=make(precision=precision))[0]
+        offset = np.hypot(runs["single"].position_x - runs["double"].position_x, runs["single"].position_y - runs["double"].position_y).max()
+        print("%-14s %16.3g %20.2e %20.2e" % (label, offset, drifts["double"], drifts["single"]))
+    kernels.enabled = compiled
+
+def quiet_system(n, seed=0):
+    # n bodies of start_mass spread thinly over a wide box, still enough to
+    # pull on each other but far from touching for thousands of steps
+    rng = np.random.default_rng(seed)
+    particles = ParticleSet(n)
+    particles.position_x[:] = rng.uniform(0, 10 ** 6, n)
+    particles.position_y[:] = rng.uniform(0, 10 ** 6, n)
+    particles.mass[:] = start_mass * 10.0 ** 11
+    particles.calculate_radius()
+    return particles
+
+def bench_workspace(sizes):
+    # The default step pipeline of main.py (grid cluster merging, direct
+    # engine, Euler and leapfrog) on a system where nothing touches, after
+    # a few warm up steps have sized the workspaces: bytes made and still
+    # held after 200 more steps, the most held at once during one step (short-lived array
+    # views and scalars), garbage collector runs and time over the steps, and
+    # the median and slowest step without tracemalloc running
+    compiled = kernels.enabled
+    box = (10 ** 6, 10 ** 6)
+    steps = 200
+    pauses = []
+
+    def watch(phase, info):
+        if phase == "start":
+            pauses.append(-time.perf_counter())
+        else:
+            pauses[-1] += time.perf_counter()
+
+    print("%8s %-10s %-6s %12s %12s %10s %10s %12s %12s" % ("N", "integrator", "numba", "kept (B)", "peak (B)", "gc runs",
+                                                         "gc (ms)", "median (ms)", "slowest (ms)"))
+    for n in sizes:
+        for integrator in (EulerIntegrator(), LeapfrogIntegrator()):
+            for numba in (True, False) if compiled else (False,):
+                kernels.enabled = numba
+                particles = quiet_system(n)
+                engine = DirectEngine()
+
+                def step():
+                    particles.collide_clusters(SpatialHash)
+                    particles.remove_merged()
+                    integrator.step(particles, engine, GRAV_CONST, 1.0, True, box)
+
+                for repeat in range(5):
+                    step()
+                times = [timed(step) for repeat in range(steps)]
+
+                pauses.clear()
+                gc.callbacks.append(watch)
+                tracemalloc.start()
+                peak = 0
+                for repeat in range(steps):
+                    tracemalloc.reset_peak()
+                    held = tracemalloc.get_traced_memory()[0]
+                    step()
+                    peak = max(peak, tracemalloc.get_traced_memory()[1] - held)
+                # What the steps made and still hold (leaving out this loop's own numbers)
+                snapshot = tracemalloc.take_snapshot().filter_traces([tracemalloc.Filter(False, __file__)])
+                kept = sum(trace.size for trace in snapshot.traces)
+                tracemalloc.stop()
+                gc.callbacks.remove(watch)
+                print("%8d %-10s %-6s %12d %12d %10d %10.2f %12.3f %12.3f" % (
+                    n, integrator.name, "on" if numba else "off", kept, peak, len(pauses), 1000 * sum(pauses),
+                    1000 * np.median(times), 1000 * max(times)))
+    kernels.enabled = compiled
+
+benchmarks = {
+    "direct": (bench_direct, [15, 200, 1000, 5000]),
+    "barnes-hut": (bench_barnes_hut, [1000, 10000, 50000]),
+    "particle-mesh": (bench_particle_mesh, [10000, 100000, 1000000]),
+    "p3m": (bench_p3m, [1000, 10000, 100000]),
+    "fmm": (bench_fmm, [250, 500, 1000, 2000, 5000, 10000, 20000, 50000]),
+    "pairs": (bench_pairs, [200, 1000, 10000, 100000]),
+    "trig": (bench_trig, [200, 1000]),
+    "memory": (bench_memory, [1000, 10000, 100000]),
+    "collisions": (bench_collisions, [1000, 5000, 20000]),
+    "merging": (bench_merging, [1000, 5000, 20000]),
+    "integrators": (bench_integrators, [10, 100]),
+    "adaptive": (bench_adaptive, [10, 100]),
+    "block": (bench_block, [100, 300]),
+    "hermite": (bench_hermite, [10, 100]),
+    "softening": (bench_softening, [100]),
+    "jit": (bench_jit, [1000, 5000, 10000]),
+    "parallel": (bench_parallel, [2000, 5000, 10000, 20000]),
+    "threaded": (bench_threaded, [1000, 2000, 5000, 10000]),
+    "blocking": (bench_blocking, [1000, 2000, 5000]),
+    "precision": (bench_precision, [1000, 5000, 10000]),
+    "workspace": (bench_workspace, [1000, 5000]),
+}
+
+if __name__ == "__main__":
+    name = sys.argv[1] if len(sys.argv) > 1 else "direct"
+    function, default_sizes = benchmarks[name]
+    sizes = [int(n) for n in sys.argv[2:]] or default_sizes
+    function(sizes)
@@ -0,0 +1,135 @@
+'''
+Body
+----------------------------
+Per-object physics for the gravity simulation. Kept apart from main.py
+(which opens the window on import) so the force engines and benchmarks
+can use it without pygame.
+'''
+import math
+
+# Constant
+GRAV_CONST = 6.67408 * (10 ** (-11))
+
+# class object
+class Object:
+    def __init__ (self, mass, position_x, position_y, color):
+        # Initialize mass and position
+        self.mass = mass
+        self.merged = False
+        self.selected = False
+        self.store_force_x = 0
+        self.store_force_y = 0
+
+        self.color = color
+
+        self.position_x = position_x
+        self.position_y = position_y
+
+        self.acceleration_x = 0
+        self.acceleration_y = 0
+
+        self.velocity_x = 0
+        self.velocity_y = 0
+
+    def calculate_radius(self):
+        # Radius is dependent on mass
+        # Assumes one unit of mass (1 * 10^11 kg) is equal to one m^2
+        self.radius = math.sqrt((self.mass / 10 ** 11) / math.pi)
+
+    def calculate_new_position(self, border, size):
+        # Velocity is change in position
+        self.position_x += self.velocity_x
+        self.position_y += self.velocity_y
+
+        if border:
+            # Check each border for collision
+            if self.position_x + self.radius > size[0]:
+                # First move the object (to prevent repeated collision)
+                self.position_x = size[0] - self.radius
+                # Velocity is reversed
+                self.velocity_x *= -1
+            if self.position_x - self.radius < 0:
+                self.position_x = self.radius
+                self.velocity_x *= -1
+            if self.position_y + self.radius > size[1]:
+                self.position_y = size[1] - self.radius
+                self.velocity_y *= -1
+            if self.position_y - self.radius < 0:
+                self.position_y = self.radius
+                self.velocity_y *= -1
+
+    def calculate_new_velocity(self, obj, grav_const=GRAV_CONST):
+        # Find force in x and y
+        force_x, force_y = self.calculate_force(obj, grav_const)
+
+        # Adds the force to the stored force
+        self.store_force_x += force_x
+        self.store_force_y += force_y
+
+        # Newton's second law
+        self.acceleration_x = force_x / self.mass
+        self.acceleration_y = force_y / self.mass
+
+        # Acceleration is change in velocity
+        self.velocity_x += self.acceleration_x
+        self.velocity_y += self.acceleration_y
+
+    def attract(self, obj, grav_const=GRAV_CONST):
+        # Same as self.calculate_new_velocity(obj) and obj.calculate_new_velocity(self),
+        # but the force is only worked out once: by Newton's third law obj feels
+        # the same force in the opposite direction
+        force_x, force_y = self.calculate_force(obj, grav_const)
+
+        self.store_force_x += force_x
+        self.store_force_y += force_y
+        obj.store_force_x -= force_x
+        obj.store_force_y -= force_y
+
+        self.acceleration_x = force_x / self.mass
+        self.acceleration_y = force_y / self.mass
+        obj.acceleration_x = -force_x / obj.mass
+        obj.acceleration_y = -force_y / obj.mass
+
+        self.velocity_x += self.acceleration_x
+        self.velocity_y += self.acceleration_y
+        obj.velocity_x += obj.acceleration_x
+        obj.velocity_y += obj.acceleration_y
+
+    def calculate_force(self, obj, grav_const=GRAV_CONST):
+        # Equation for gravity (using big G), split into x and y without any trig:
+        # F * cos(angle) = (G * m1 * m2 / r^2) * (diff_x / r) = G * m1 * m2 * diff_x / r^3
+        diff_x = obj.position_x - self.position_x
+        diff_y = obj.position_y - self.position_y
+        inverse_distance = 1 / math.sqrt(diff_x * diff_x + diff_y * diff_y)
+        strength = grav_const * (self.mass * obj.mass) * (inverse_distance * inverse_distance * inverse_distance)
+        return strength * diff_x, strength * diff_y
+
+    def collision(self, obj):
+        # Gets distance beteween two objects
+        difference_x = self.position_x - obj.position_x
+        difference_y = self.position_y - obj.position_y
+        position = math.sqrt(difference_x ** 2 + difference_y ** 2)
+
+        # If the distance between the two is less than the two object's radii, they collided
+        if position <= (self.radius + obj.radius):
+            momentum_x = self.mass * self.velocity_x + obj.mass * obj.velocity_x
+            momentum_y = self.mass * self.velocity_y + obj.mass * obj.velocity_y
+
+            # Merges to the larger mass
+            if self.mass > obj.mass:
+                # Using conservation of momentum and assumes perfectly inelastic collision
+                self.mass += obj.mass
+                self.velocity_x = momentum_x / self.mass
+                self.velocity_y = momentum_y / self.mass
+
+                # Merged objects disappear
+                obj.merged = True
+
+                # Recalculates radius based on new mass
+                self.calculate_radius()
+            else:
+                obj.mass += self.mass
+                obj.velocity_x = momentum_x / obj.mass
+                obj.velocity_y = momentum_y / obj.mass
+                self.merged = True
+                obj.calculate_radius()
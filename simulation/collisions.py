@@ -0,0 +1,362 @@
+'''
+Collisions
+----------------------------
+Broad phases that find which bodies could be touching without testing
+every pair, and the merge pass that runs ParticleSet.merge on just those
+pairs.
+'''
+import heapq
+
+import numpy as np
+
+import kernels
+from engines import neighbour_pairs
+
+# When resolve() rebuilds the broad phase or gives up on it for brute force rows
+brute_force_fraction = 0.25
+crowded_fraction = 0.05
+grown_limit = 32
+
+# Uniform grid with cells as wide as the largest body. Two touching bodies
+# are never more than one cell apart, so only the same and the eight
+# neighbouring cells need looking at
+class SpatialHash:
+    name = "grid"
+
+    def __init__(self, particles):
+        live = ~particles.merged
+        self.position_x = particles.position_x
+        self.position_y = particles.position_y
+        self.cell = 2 * particles.radius[live].max() if live.any() else 1.0
+        if self.cell <= 0:
+            self.cell = 1.0
+        # Largest radius the grid was built for
+        self.reach = self.cell / 2
+
+        # Bodies sorted by cell, so each row of cells is one slice
+        cell_x = np.floor(self.position_x / self.cell).astype(np.int64)
+        cell_y = np.floor(self.position_y / self.cell).astype(np.int64)
+        self.left = cell_x.min() if len(cell_x) else 0
+        self.top = cell_y.min() if len(cell_y) else 0
+        self.cell_x = cell_x - self.left
+        self.cell_y = cell_y - self.top
+        self.width = self.cell_x.max() + 1 if len(cell_x) else 1
+        self.height = self.cell_y.max() + 1 if len(cell_y) else 1
+        key = self.cell_y * self.width + self.cell_x
+        self.order = np.argsort(key, kind="stable")
+        self.sorted_key = key[self.order]
+
+    def crowded(self):
+        # Whether the cells hold so many bodies that the pairs from
+        # candidates() would be about as many as all pairs
+        counts = np.unique(self.sorted_key, return_counts=True)[1]
+        return 9 * np.dot(counts, counts) / 2 > len(self.position_x) ** 2 * crowded_fraction
+
+    def candidates(self):
+        # Every pair that could touch, each pair once
+        firsts = []
+        seconds = []
+        if len(self.position_x):
+            for first, second in neighbour_pairs(self.position_x, self.position_y, self.cell):
+                firsts.append(first)
+                seconds.append(second)
+        if not firsts:
+            return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64)
+        return np.concatenate(firsts), np.concatenate(seconds)
+
+    def nearby(self, index, reach):
+        # Indexes (ascending) of every body whose cell is within `reach` of body `index`
+        steps = int(np.ceil(reach / self.cell))
+        cell_x = self.cell_x[index]
+        cell_y = self.cell_y[index]
+        low_x = max(0, cell_x - steps)
+        high_x = min(self.width - 1, cell_x + steps)
+        parts = []
+        for row in range(max(0, cell_y - steps), min(self.height - 1, cell_y + steps) + 1):
+            start = np.searchsorted(self.sorted_key, row * self.width + low_x, "left")
+            end = np.searchsorted(self.sorted_key, row * self.width + high_x, "right")
+            parts.append(self.order[start:end])
+        return np.sort(np.concatenate(parts))
+
+# Sweep and prune: bodies sorted by the left end of their x-interval
+# (position - radius), so the bodies overlapping one in x are the run right
+# after it in the order. Each body uses its own radius, which suits clustered
+# scenes where a few bodies are far bigger than the rest.
+# One instance is kept for the whole run and called once per step. It
+# re-sorts the order from the last step, which is nearly sorted already as
+# bodies only move a little per step (timsort finishes it in close to
+# linear time)
+class SweepAndPrune:
+    name = "sweep"
+
+    def __init__(self):
+        # Id array of the set at the last call, and the ids in sorted order
+        self.id = None
+        self.sorted_id = np.zeros(0, dtype=np.int64)
+
+    def __call__(self, particles):
+        self.position_x = particles.position_x
+        self.position_y = particles.position_y
+        radius = particles.radius
+        live = ~particles.merged
+        # Largest radius the order was built for
+        self.reach = radius[live].max() if live.any() else 0.0
+
+        if particles.id is self.id:
+            # Same bodies as last call
+            order = self.order
+        else:
+            # Last call's order, minus the bodies that have gone (ids are
+            # sorted, see ParticleSet.remove_merged), plus any new ones at the end
+            index = np.searchsorted(particles.id, self.sorted_id)
+            present = index < len(particles.id)
+            present[present] = particles.id[index[present]] == self.sorted_id[present]
+            order = index[present]
+            missing = np.ones(len(particles.id), dtype=bool)
+            missing[order] = False
+            order = np.concatenate([order, np.flatnonzero(missing)])
+            self.id = particles.id
+
+        left = self.position_x - radius
+        self.order = order[np.argsort(left[order], kind="stable")]
+        self.sorted_left = left[self.order]
+        self.sorted_id = particles.id[self.order]
+        self.sorted_radius = radius[self.order]
+
+        # Bodies overlapping body order[k] in x are order[k + 1:end[k]]
+        right = (self.position_x + radius)[self.order]
+        self.end = np.searchsorted(self.sorted_left, right, "right")
+        return self
+
+    def crowded(self):
+        # Whether most pairs overlap in x anyway
+        count = np.maximum(self.end - np.arange(len(self.end)) - 1, 0)
+        return count.sum() > len(self.end) ** 2 * crowded_fraction
+
+    def candidates(self, batch=1 << 20):
+        # Every pair whose intervals overlap in both x and y, each pair once
+        firsts = []
+        seconds = []
+        number = len(self.end)
+        count = np.maximum(self.end - np.arange(number) - 1, 0)
+        total = np.cumsum(count)
+        if number and total[-1]:
+            cuts = [0] + list(np.searchsorted(total, np.arange(batch, total[-1], batch))) + [number]
+            for low, high in zip(cuts[:-1], cuts[1:]):
+                part = count[low:high]
+                rank = np.repeat(np.arange(low, high), part)
+                step = np.arange(part.sum()) - np.repeat(np.cumsum(part) - part, part)
+                other = rank + 1 + step
+                first = self.order[rank]
+                second = self.order[other]
+                overlap = np.abs(self.position_y[second] - self.position_y[first]) <= self.sorted_radius[rank] + self.sorted_radius[other]
+                firsts.append(first[overlap])
+                seconds.append(second[overlap])
+        if not firsts:
+            return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64)
+        return np.concatenate(firsts), np.concatenate(seconds)
+
+    def nearby(self, index, reach):
+        # Indexes (ascending) of every body within `reach` of body `index` in
+        # both x and y. Left ends are at most self.reach short of the centres
+        position_x = self.position_x[index]
+        start = np.searchsorted(self.sorted_left, position_x - reach - self.reach, "left")
+        end = np.searchsorted(self.sorted_left, position_x + reach, "right")
+        near = self.order[start:end]
+        close = (np.abs(self.position_x[near] - position_x) <= reach) & (np.abs(self.position_y[near] - self.position_y[index]) <= reach)
+        return np.sort(near[close])
+
+def touching(particles, index, others):
+    # Which of `others` touch body `index` (same test as Object.collision)
+    diff_x = particles.position_x[others] - particles.position_x[index]
+    diff_y = particles.position_y[others] - particles.position_y[index]
+    touch = np.sqrt(diff_x ** 2 + diff_y ** 2) <= particles.radius[index] + particles.radius[others]
+    return others[touch & ~particles.merged[others] & (others != index)]
+
+def resolve(particles, broad_phase):
+    # Merges touching bodies in exactly the order the brute-force pass would
+    # (rows of x ascending, then y ascending, radii growing as bodies merge),
+    # but only visits rows of bodies that touch something
+    broad = broad_phase(particles)
+    if broad.crowded():
+        particles.collide_rows()
+        return
+    first, second = broad.candidates()
+    diff_x = particles.position_x[second] - particles.position_x[first]
+    diff_y = particles.position_y[second] - particles.position_y[first]
+    touch = np.sqrt(diff_x ** 2 + diff_y ** 2) <= particles.radius[first] + particles.radius[second]
+    touch &= ~particles.merged[first] & ~particles.merged[second]
+    rows = np.unique(np.concatenate([first[touch], second[touch]])).tolist()
+    if not rows:
+        return
+    # When most bodies overlap (e.g. right after a restart with a big mass)
+    # plain rows over every body are cheaper than following merges around
+    if len(rows) > len(particles) * brute_force_fraction:
+        particles.collide_rows()
+        return
+    pending = set(rows)
+
+    # Bodies that outgrow the broad phase's reach during the pass are
+    # checked against every body instead of widening every search. If there
+    # get to be many, the broad phase is built again around the new radii
+    reach = broad.reach
+    grown = []
+
+    def neighbours(index):
+        near = broad.nearby(index, particles.radius[index] + reach)
+        if grown:
+            near = np.union1d(near, grown)
+        return touching(particles, index, near)
+
+    while rows:
+        x = heapq.heappop(rows)
+        pending.discard(x)
+        if len(grown) > grown_limit:
+            broad = broad_phase(particles)
+            if broad.crowded():
+                particles.collide_rows(x)
+                return
+            reach = broad.reach
+            grown = []
+        y = -1
+        while not particles.merged[x]:
+            near = neighbours(x)
+            near = near[near > y]
+            if len(near) == 0:
+                break
+            y = near[0]
+            winner = particles.merge(x, y)
+            if particles.radius[winner] > reach and winner not in grown:
+                grown.append(winner)
+
+            # The winner grew: bodies it touches now need their row checked
+            # (and its own row, if that is still to come)
+            around = neighbours(winner)
+            later = around[around > x].tolist()
+            if winner > x and len(around):
+                later.append(winner)
+            for z in later:
+                if z not in pending:
+                    pending.add(z)
+                    heapq.heappush(rows, z)
+
+def touching_pairs(particles, broad_phase=None, batch=1 << 20):
+    # Pairs (i array, j array) of live bodies touching right now, each pair
+    # once, in batches of about `batch` pairs tested
+    broad = broad_phase(particles) if broad_phase is not None else None
+    if broad is not None and not broad.crowded():
+        first, second = broad.candidates()
+        diff_x = particles.position_x[second] - particles.position_x[first]
+        diff_y = particles.position_y[second] - particles.position_y[first]
+        touch = np.sqrt(diff_x ** 2 + diff_y ** 2) <= particles.radius[first] + particles.radius[second]
+        touch &= ~particles.merged[first] & ~particles.merged[second]
+        yield first[touch], second[touch]
+        return
+
+    # Blocks of rows, each tested against every later body at once
+    number = len(particles)
+    rows = np.flatnonzero(~particles.merged)
+    step = max(1, batch // max(number, 1))
+    for low in range(0, len(rows), step):
+        block = rows[low:low + step]
+        diff_x = particles.position_x - particles.position_x[block, None]
+        diff_y = particles.position_y - particles.position_y[block, None]
+        touch = np.sqrt(diff_x ** 2 + diff_y ** 2) <= particles.radius[block, None] + particles.radius
+        touch &= ~particles.merged
+        touch &= np.arange(number) > block[:, None]
+        row, second = np.nonzero(touch)
+        yield block[row], second
+
+def grid_touching_pairs(particles, batch=1 << 20):
+    # touching_pairs() for the grid in one compiled pass (kernels.grid_touching),
+    # in the set's workspace: no new arrays unless the pair buffers have to grow.
+    # None if more than `batch` pairs touch (most bodies overlap), which
+    # touching_pairs() works through in batches instead
+    number = len(particles)
+    workspace = particles.workspace
+    buckets = 1 << (2 * number).bit_length()
+    cell_x = workspace.get("cell_x", number, np.int64)
+    cell_y = workspace.get("cell_y", number, np.int64)
+    packed = workspace.get("packed", number, np.int64)
+    capacity = number
+    while True:
+        first = workspace.get("first", capacity, np.int64)
+        second = workspace.get("second", capacity, np.int64)
+        found = kernels.grid_touching(particles.position_x, particles.position_y, particles.radius, particles.merged,
+                                      buckets, cell_x, cell_y, packed, first, second)
+        if found <= capacity:
+            return first[:found], second[:found]
+        if found > batch:
+            return None
+        capacity = found
+
+def union_find(parent, first, second):
+    # Joins the clusters of each pair (first[i], second[i]). parent holds the
+    # root of every body's cluster (the lowest index in it) and is returned
+    # updated. Done for all pairs at once: each round hooks the larger root of
+    # every pair under the smaller one, then halves the paths until every
+    # body points at its root again
+    while True:
+        root_first = parent[first]
+        root_second = parent[second]
+        apart = root_first != root_second
+        if not apart.any():
+            return parent
+        first = first[apart]
+        second = second[apart]
+        low = np.minimum(root_first[apart], root_second[apart])
+        high = np.maximum(root_first[apart], root_second[apart])
+        np.minimum.at(parent, high, low)
+        while True:
+            grand = parent[parent]
+            if np.array_equal(grand, parent):
+                break
+            parent = grand
+
+def merge_clusters(particles, broad_phase=None):
+    # Merges every group of bodies that touch (directly or through each
+    # other) into its heaviest body in one go, conserving momentum. Unlike
+    # merging pair by pair, the result doesn't depend on the order of the
+    # bodies: each cluster's sums are added up in order of id, and ties for
+    # heaviest go to the lowest id.
+    # The grid has a compiled pass, and the per-body arrays are only made
+    # once something touches, so a step without collisions makes no arrays
+    batches = None
+    if kernels.enabled and broad_phase is SpatialHash:
+        pairs = grid_touching_pairs(particles)
+        if pairs is not None:
+            batches = [pairs]
+    if batches is None:
+        batches = touching_pairs(particles, broad_phase)
+    touched = None
+    for first, second in batches:
+        if len(first) == 0:
+            continue
+        if touched is None:
+            root = np.arange(len(particles))
+            touched = np.zeros(len(particles), dtype=bool)
+        root = union_find(root, first, second)
+        touched[first] = True
+        touched[second] = True
+    if touched is None:
+        return
+
+    # Each cluster in one run, in order of id inside it
+    members = np.flatnonzero(touched)
+    members = members[np.lexsort((particles.id[members], root[members]))]
+    cluster = root[members]
+    mass = particles.mass[members]
+    starts = np.flatnonzero(np.concatenate([[True], cluster[1:] != cluster[:-1]]))
+    total = np.add.reduceat(mass, starts)
+    momentum_x = np.add.reduceat(mass * particles.velocity_x[members], starts)
+    momentum_y = np.add.reduceat(mass * particles.velocity_y[members], starts)
+
+    # The heaviest body (lowest id on a tie) keeps its place, id and colour
+    by_weight = np.lexsort((particles.id[members], -mass, cluster))
+    winner = members[by_weight[starts]]
+    particles.merged[members] = True
+    particles.merged[winner] = False
+    particles.mass[winner] = total
+    particles.velocity_x[winner] = momentum_x / total
+    particles.velocity_y[winner] = momentum_y / total
+    particles.radius[winner] = np.sqrt((total / 10 ** 11) / np.pi)
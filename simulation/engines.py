@@ -0,0 +1,1027 @@
+'''
+Force Engines
+----------------------------
+Each engine takes contiguous arrays of positions and masses (straight from
+a ParticleSet) and returns the gravitational acceleration on every body in
+one batched pass, instead of calling Object.calculate_new_velocity once per
+pair.
+'''
+import atexit
+import math
+import multiprocessing
+import os
+import signal
+from concurrent.futures import ThreadPoolExecutor
+from multiprocessing import resource_tracker, shared_memory
+
+import numpy as np
+
+import kernels
+from workspace import Workspace
+
+def cap(largest, acceleration_x, acceleration_y, *rest):
+    # Scales each body's acceleration down to at most `largest` (None leaves
+    # it alone), in place. Any further arrays (jerks) are scaled by the same
+    # factor
+    if largest is None:
+        return (acceleration_x, acceleration_y) + rest
+    magnitude = np.sqrt(acceleration_x ** 2 + acceleration_y ** 2)
+    scale = largest / np.maximum(magnitude, largest)
+    for value in (acceleration_x, acceleration_y) + rest:
+        value *= scale
+    return (acceleration_x, acceleration_y) + rest
+
+# Every engine takes two optional limits for close encounters:
+# softening is a Plummer softening length, the pull between two bodies goes
+# as r / (r^2 + softening^2)^(3/2), so it peaks near `softening` and falls
+# back to zero as they overlap instead of growing without bound.
+# max_acceleration caps the size of each body's total acceleration.
+# Both keep a near miss from flinging bodies apart or (with --adaptive)
+# cutting dt down to almost nothing. 0 and None leave the physics exact
+
+# The direct and Barnes-Hut engines can work out the pair terms in float32
+# ("single"): half the memory traffic and twice the numbers per SIMD
+# instruction. Sums and everything the integrators keep (positions,
+# velocities) stay float64. Pulls come out about 1e-6 off (see benchmark.py
+# precision), far below what shows on screen
+PRECISIONS = {"double": np.float64, "single": np.float32}
+
+def lowered(dtype, position_x, position_y, mass):
+    # The arrays in dtype for the pair terms. Positions are moved so the
+    # bodies sit around 0 first, so float32 keeps as many of their digits as
+    # it can (differences between positions don't change)
+    if dtype is np.float64 or len(mass) == 0:
+        return position_x, position_y, mass
+    middle_x = (position_x.min() + position_x.max()) / 2
+    middle_y = (position_y.min() + position_y.max()) / 2
+    return (position_x - middle_x).astype(dtype), (position_y - middle_y).astype(dtype), mass.astype(dtype)
+
+# Exact all-pairs sum. Still O(N^2) work, but done inside numpy instead of
+# N^2 python method calls. The numpy version goes through `block` rows
+# (target bodies) at a time, so its temporary arrays are block x N in
+# buffers kept from call to call, instead of several N x N ones (gigabytes
+# at 10^4 bodies). Each row is still summed in one go, so the result is the
+# same as the whole matrix at once, and the blocks stay in cache.
+# With `out` (a pair of arrays, as ParticleSet passes its acceleration
+# arrays) the result is written there, and in double precision a call makes
+# no new arrays at all
+class DirectEngine:
+    name = "direct"
+    block = 32
+
+    def __init__(self, softening=0.0, max_acceleration=None, precision="double"):
+        self.softening = softening
+        self.max_acceleration = max_acceleration
+        self.dtype = PRECISIONS[precision]
+        self.scratch = np.empty((0, 0), self.dtype)
+        self.workspace = Workspace()
+
+    def buffers(self, count, rows, number):
+        # `count` scratch arrays of rows x number, views into self.scratch
+        # (which only grows)
+        if self.scratch.shape[0] < count or self.scratch.shape[1] < rows * number:
+            self.scratch = np.empty((max(count, self.scratch.shape[0]), max(rows * number, self.scratch.shape[1])), self.scratch.dtype)
+        return [self.scratch[index, :rows * number].reshape(rows, number) for index in range(count)]
+
+    def accelerations(self, position_x, position_y, mass, grav_const, targets=None, out=None):
+        # Row i holds the vector from body i to every other body j. With
+        # targets only the rows of those bodies are worked out (and returned)
+        number = len(mass)
+        everyone = targets is None
+        if everyone:
+            targets = self.workspace.indexes(number)
+        if out is None:
+            out = np.empty(len(targets)), np.empty(len(targets))
+        acceleration_x, acceleration_y = out
+        position_x, position_y, mass = lowered(self.dtype, position_x, position_y, mass)
+        if kernels.enabled and everyone:
+            # Every pair once, see kernels.direct_accelerations_all
+            kernels.direct_accelerations_all(position_x, position_y, mass, self.dtype(grav_const), self.dtype(self.softening),
+                                             acceleration_x, acceleration_y)
+            return cap(self.max_acceleration, acceleration_x, acceleration_y)
+        if kernels.enabled:
+            kernels.direct_accelerations(position_x, position_y, mass, self.dtype(grav_const), self.dtype(self.softening),
+                                         targets, acceleration_x, acceleration_y)
+            return cap(self.max_acceleration, acceleration_x, acceleration_y)
+        pull = np.multiply(self.dtype(grav_const), mass, out=self.workspace.get("pull", number, self.dtype))
+        row_x = self.workspace.get("row_x", self.block, self.dtype)
+        row_y = self.workspace.get("row_y", self.block, self.dtype)
+        for start in range(0, len(targets), self.block):
+            rows = targets[start:start + self.block]
+            diff_x, diff_y, distance_sq, strength = self.buffers(4, len(rows), number)
+            column_x = np.take(position_x, rows, out=row_x[:len(rows)])
+            column_y = np.take(position_y, rows, out=row_y[:len(rows)])
+            np.subtract(position_x[np.newaxis, :], column_x[:, np.newaxis], out=diff_x)
+            np.subtract(position_y[np.newaxis, :], column_y[:, np.newaxis], out=diff_y)
+            np.multiply(diff_x, diff_x, out=distance_sq)
+            np.multiply(diff_y, diff_y, out=strength)
+            distance_sq += strength
+
+            # A body does not pull on itself (or on one sitting exactly on top of it)
+            itself = self.workspace.get("itself", len(rows) * number, bool).reshape(len(rows), number)
+            np.putmask(distance_sq, np.equal(distance_sq, 0, out=itself), np.inf)
+            distance_sq += self.softening ** 2
+
+            # G * m_j / r^2 along the direction (dx / r, dy / r)
+            np.sqrt(distance_sq, out=strength)
+            strength *= distance_sq
+            np.divide(pull, strength, out=strength)
+            diff_x *= strength
+            diff_y *= strength
+            diff_x.sum(axis=1, dtype=np.float64, out=acceleration_x[start:start + self.block])
+            diff_y.sum(axis=1, dtype=np.float64, out=acceleration_y[start:start + self.block])
+        return cap(self.max_acceleration, acceleration_x, acceleration_y)
+
+    def accelerations_and_jerks(self, position_x, position_y, velocity_x, velocity_y, mass, grav_const):
+        # Accelerations plus their rate of change (jerk), for the Hermite
+        # integrator: d/dt of G * m_j * r / |r|^3 is
+        # G * m_j * (v / |r|^3 - 3 * (r . v) * r / |r|^5)
+        # Always in float64: Hermite is for runs that want the accuracy
+        if kernels.enabled:
+            return cap(self.max_acceleration, *kernels.direct_accelerations_and_jerks(
+                position_x, position_y, velocity_x, velocity_y, mass, grav_const, self.softening))
+        number = len(mass)
+        acceleration_x, acceleration_y, jerk_x, jerk_y = np.empty((4, number))
+        pull = grav_const * mass[np.newaxis, :]
+        for start in range(0, number, self.block):
+            rows = slice(start, start + self.block)
+            diff_x, diff_y, relative_x, relative_y, distance_sq, strength, approach, term = self.buffers(
+                8, len(mass[rows]), number)
+            np.subtract(position_x[np.newaxis, :], position_x[rows, np.newaxis], out=diff_x)
+            np.subtract(position_y[np.newaxis, :], position_y[rows, np.newaxis], out=diff_y)
+            np.subtract(velocity_x[np.newaxis, :], velocity_x[rows, np.newaxis], out=relative_x)
+            np.subtract(velocity_y[np.newaxis, :], velocity_y[rows, np.newaxis], out=relative_y)
+            np.multiply(diff_x, diff_x, out=distance_sq)
+            np.multiply(diff_y, diff_y, out=term)
+            distance_sq += term
+            np.putmask(distance_sq, distance_sq == 0, np.inf)
+            distance_sq += self.softening ** 2
+
+            np.sqrt(distance_sq, out=strength)
+            strength *= distance_sq
+            np.divide(pull, strength, out=strength)
+
+            # 3 * (r . v) / |r|^2
+            np.multiply(diff_x, relative_x, out=approach)
+            np.multiply(diff_y, relative_y, out=term)
+            approach += term
+            approach *= 3
+            approach /= distance_sq
+
+            np.multiply(approach, diff_x, out=term)
+            np.subtract(relative_x, term, out=term)
+            term *= strength
+            term.sum(axis=1, out=jerk_x[rows])
+            np.multiply(approach, diff_y, out=term)
+            np.subtract(relative_y, term, out=term)
+            term *= strength
+            term.sum(axis=1, out=jerk_y[rows])
+            diff_x *= strength
+            diff_y *= strength
+            diff_x.sum(axis=1, out=acceleration_x[rows])
+            diff_y.sum(axis=1, out=acceleration_y[rows])
+        return cap(self.max_acceleration, acceleration_x, acceleration_y, jerk_x, jerk_y)
+
+# The direct sum split over a pool of worker processes, for machines with
+# many cores. Positions, masses and results sit in one block of shared
+# memory: the parent copies the positions in, each worker works out its share
+# of the rows and writes them straight into the result, so a step only sends
+# every worker a few numbers (which rows), never the arrays. Each row is
+# summed by one worker in the same order whatever the number of workers, so
+# results don't depend on it. Workers are forked where the platform can:
+# a spawned worker imports the main script again, so a script that uses the
+# engine without fork needs an `if __name__ == "__main__"` guard (main.py
+# refuses the engine there instead). Once a parallel_jit kernel has run
+# (Barnes-Hut), numba's threads are running and a forked process never
+# exits, so the workers come from a fresh forkserver process instead (which
+# imports the main script again too, main.py starts the pool before that).
+# start_pool() starts them, main.py does so before opening the window, and
+# they are kept for the whole run; close() stops them
+class ParallelEngine(DirectEngine):
+    name = "parallel"
+    # Rows a worker sums at a time, keeps its temporary arrays at tile x N
+    tile = 256
+    # Row chunks per worker and step, so a slow worker doesn't hold up the rest
+    chunks = 4
+
+    def __init__(self, workers=None, softening=0.0, max_acceleration=None):
+        DirectEngine.__init__(self, softening, max_acceleration)
+        self.workers = workers or os.cpu_count() or 1
+        self.pool = None
+        self.memory = None
+        self.capacity = 0
+
+    def start_pool(self):
+        # Starts the worker processes, if they aren't running yet. The
+        # resource tracker is started first so the workers share it: one of
+        # their own would unlink the shared block when its worker exits
+        if self.pool is None:
+            methods = multiprocessing.get_all_start_methods()
+            if kernels.threads_started and "forkserver" in methods:
+                method = "forkserver"
+            else:
+                method = "fork" if "fork" in methods else None
+            resource_tracker.ensure_running()
+            self.pool = multiprocessing.get_context(method).Pool(self.workers, worker_start)
+            atexit.register(self.close)
+
+    def free_memory(self):
+        # Lets go of the shared block (already gone if something else
+        # unlinked it)
+        self.memory.close()
+        try:
+            self.memory.unlink()
+        except FileNotFoundError:
+            pass
+        self.memory = None
+
+    def start(self, number):
+        # Makes the shared block big enough for `number` bodies (it only
+        # grows), and the pool the first time
+        if number > self.capacity:
+            if self.memory is not None:
+                self.free_memory()
+            self.capacity = max(number, 2 * self.capacity)
+            self.memory = shared_memory.SharedMemory(create=True, size=shared_size(self.capacity))
+        self.start_pool()
+        return shared_arrays(self.memory.buf, self.capacity)
+
+    def accelerations(self, position_x, position_y, mass, grav_const, targets=None, out=None):
+        number = len(mass)
+        if targets is None:
+            targets = self.workspace.indexes(number)
+        if out is None:
+            out = np.empty(len(targets)), np.empty(len(targets))
+        if len(targets) == 0:
+            return out
+        shared_x, shared_y, shared_mass, shared_targets, acceleration_x, acceleration_y = self.start(number)
+        shared_x[:number] = position_x
+        shared_y[:number] = position_y
+        shared_mass[:number] = mass
+        shared_targets[:len(targets)] = targets
+
+        bounds = np.linspace(0, len(targets), min(len(targets), self.chunks * self.workers) + 1).astype(np.int64)
+        tasks = [(self.memory.name, self.capacity, number, low, high, grav_const, self.softening)
+                 for low, high in zip(bounds[:-1], bounds[1:])]
+        self.pool.starmap(worker_rows, tasks)
+        out[0][:] = acceleration_x[:len(targets)]
+        out[1][:] = acceleration_y[:len(targets)]
+        return cap(self.max_acceleration, *out)
+
+    def close(self):
+        if self.pool is not None:
+            # Workers ignore termination signals (see worker_start), they are
+            # told to finish instead
+            self.pool.close()
+            self.pool.join()
+            self.pool = None
+        if self.memory is not None:
+            self.free_memory()
+            self.capacity = 0
+
+def shared_size(capacity):
+    return 6 * capacity * 8
+
+def shared_arrays(buffer, capacity):
+    # The shared block as position_x, position_y, mass, targets (which rows
+    # to work out), acceleration_x and acceleration_y, `capacity` long each
+    position_x, position_y, mass = np.ndarray((3, capacity), np.float64, buffer)
+    targets = np.ndarray(capacity, np.int64, buffer, 3 * capacity * 8)
+    acceleration_x, acceleration_y = np.ndarray((2, capacity), np.float64, buffer, 4 * capacity * 8)
+    return position_x, position_y, mass, targets, acceleration_x, acceleration_y
+
+# Shared blocks this worker process is attached to, by name
+attached = {}
+# Kept between steps, for its scratch buffers
+worker_engine = DirectEngine()
+
+def worker_start():
+    # Runs in each new worker. Ctrl+C and termination signals (which reach
+    # the whole process group) are left to the parent: a worker killed in
+    # the middle of a step would leave the parent waiting for its rows
+    # forever. The parent stops the workers through close()
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGTERM, signal.SIG_IGN)
+
+def worker_rows(name, capacity, number, low, high, grav_const, softening):
+    # Runs in a worker: the rows of targets[low:high], written into the
+    # shared result. A new name means the parent grew the block
+    if name not in attached:
+        for memory in attached.values():
+            memory.close()
+        attached.clear()
+        attached[name] = shared_memory.SharedMemory(name=name)
+    position_x, position_y, mass, targets, acceleration_x, acceleration_y = shared_arrays(attached[name].buf, capacity)
+    engine = worker_engine
+    engine.softening = softening
+    for start in range(low, high, ParallelEngine.tile):
+        stop = min(start + ParallelEngine.tile, high)
+        engine.accelerations(position_x[:number], position_y[:number], mass[:number], grav_const, targets[start:stop],
+                             out=(acceleration_x[start:stop], acceleration_y[start:stop]))
+
+# The direct sum cut into tiles of `tile` target bodies by `tile` pulling
+# bodies and run on a pool of threads, for when forking processes costs more
+# than it saves (N of a few thousand). A tile is small enough to stay in
+# cache and is worked out by code that lets go of the GIL: the numba kernel
+# (compiled with nogil), or numpy, which drops it inside each array
+# operation. Every tile writes its own partial sums, which are then added up
+# in order of the pulling tiles, so results don't depend on the number of
+# threads (but differ from `direct` in the last bits, which adds them up in
+# a different order)
+class ThreadedEngine(DirectEngine):
+    name = "threaded"
+
+    def __init__(self, workers=None, tile=256, softening=0.0, max_acceleration=None):
+        DirectEngine.__init__(self, softening, max_acceleration)
+        self.workers = workers or os.cpu_count() or 1
+        self.tile = tile
+        self.pool = None
+
+    def accelerations(self, position_x, position_y, mass, grav_const, targets=None, out=None):
+        number = len(mass)
+        if targets is None:
+            targets = self.workspace.indexes(number)
+        if out is None:
+            out = np.empty(len(targets)), np.empty(len(targets))
+        if self.pool is None:
+            self.pool = ThreadPoolExecutor(self.workers)
+        rows = range(0, len(targets), self.tile)
+        columns = range(0, number, self.tile)
+        partial_x = np.zeros((len(columns), len(targets)))
+        partial_y = np.zeros((len(columns), len(targets)))
+
+        def work(tile):
+            row, column = tile
+            target = targets[row:row + self.tile]
+            bounds = np.array([column, min(column + self.tile, number)])
+            out_x = partial_x[column // self.tile, row:row + self.tile]
+            out_y = partial_y[column // self.tile, row:row + self.tile]
+            if kernels.enabled:
+                kernels.tile_accelerations(position_x, position_y, mass, grav_const, self.softening, target, bounds, out_x, out_y)
+            else:
+                out_x[:], out_y[:] = self.tile_accelerations(position_x, position_y, mass, grav_const, target, bounds)
+
+        # list() waits for every tile (and raises any error from one)
+        list(self.pool.map(work, [(row, column) for row in rows for column in columns]))
+        partial_x.sum(axis=0, out=out[0])
+        partial_y.sum(axis=0, out=out[1])
+        return cap(self.max_acceleration, *out)
+
+    def tile_accelerations(self, position_x, position_y, mass, grav_const, targets, bounds):
+        # numpy version of kernels.tile_accelerations
+        low, high = bounds
+        diff_x = position_x[np.newaxis, low:high] - position_x[targets, np.newaxis]
+        diff_y = position_y[np.newaxis, low:high] - position_y[targets, np.newaxis]
+        distance_sq = diff_x ** 2 + diff_y ** 2
+        distance_sq[distance_sq == 0] = np.inf
+        distance_sq += self.softening ** 2
+        strength = grav_const * mass[np.newaxis, low:high] / (distance_sq * np.sqrt(distance_sq))
+        return (strength * diff_x).sum(axis=1), (strength * diff_y).sum(axis=1)
+
+    def close(self):
+        if self.pool is not None:
+            self.pool.shutdown()
+            self.pool = None
+
+def spread_bits(value):
+    # The low 32 bits of value moved to the even bit positions (bit k to 2k)
+    value = (value | (value << 16)) & 0x0000FFFF0000FFFF
+    value = (value | (value << 8)) & 0x00FF00FF00FF00FF
+    value = (value | (value << 4)) & 0x0F0F0F0F0F0F0F0F
+    value = (value | (value << 2)) & 0x3333333333333333
+    return (value | (value << 1)) & 0x5555555555555555
+
+# Barnes-Hut: a quadtree over the bodies where far away cells are treated as
+# one body sitting at their center of mass. O(N log N) per step.
+# theta is the opening angle, a cell is used whole when
+# cell width / distance < theta. Smaller is more accurate, 0 is exact.
+# The tree is built with numpy, the walk runs compiled (kernels.py) on every
+# core when numba is there, and as numpy one level at a time otherwise.
+class BarnesHutEngine:
+    name = "barnes-hut"
+    # Deepest level of the tree. Bodies closer than world / 2^max_depth share a
+    # cell, which only happens right before they collide
+    max_depth = 20
+
+    def __init__(self, theta=0.5, softening=0.0, max_acceleration=None, precision="double"):
+        self.theta = theta
+        self.softening = softening
+        self.max_acceleration = max_acceleration
+        self.dtype = PRECISIONS[precision]
+
+    def build(self, position_x, position_y, mass):
+        # Square box around every body
+        left = position_x.min()
+        top = position_y.min()
+        width = max(position_x.max() - left, position_y.max() - top) * (1 + 1e-9) or 1.0
+        cells = 2 ** self.max_depth
+        cell_x = np.minimum(((position_x - left) / width * cells).astype(np.int64), cells - 1)
+        cell_y = np.minimum(((position_y - top) / width * cells).astype(np.int64), cells - 1)
+
+        # Morton (Z order) key of each body's deepest cell: the bits of cell_x
+        # and cell_y interleaved. A cell's code on any level is the key shifted
+        # right, so sorting the bodies once sorts them for every level
+        key = (spread_bits(cell_x) << 1) | spread_bits(cell_y)
+        order = np.argsort(key, kind="stable")
+        sorted_key = key[order]
+        sorted_mass = mass[order]
+        sorted_moment_x = (mass * position_x)[order]
+        sorted_moment_y = (mass * position_y)[order]
+
+        # One entry per level, built from the root down until every cell holds one body
+        levels = []
+        for level in range(self.max_depth + 1):
+            code = sorted_key >> 2 * (self.max_depth - level)
+            first = np.concatenate([[True], code[1:] != code[:-1]])
+            starts = np.flatnonzero(first)
+            owner = np.empty(len(mass), dtype=np.int64)
+            owner[order] = np.cumsum(first) - 1
+            node_mass = np.add.reduceat(sorted_mass, starts)
+            levels.append({
+                "codes": code[starts],
+                "owner": owner,
+                "width": width / 2 ** level,
+                "mass": node_mass,
+                "center_x": np.add.reduceat(sorted_moment_x, starts) / node_mass,
+                "center_y": np.add.reduceat(sorted_moment_y, starts) / node_mass,
+                "count": np.diff(np.append(starts, len(mass))),
+            })
+            if levels[-1]["count"].max() == 1:
+                break
+        self.link_children(levels)
+        # The root also keeps every body's key, and the bodies in key order
+        # (for the compiled walk)
+        levels[0]["key"] = key
+        levels[0]["order"] = order
+        return levels
+
+    def link_children(self, levels):
+        # For every cell, the index of each of its four children one level down
+        # (-1 if empty). A child's code is its parent's with two more bits, and
+        # every cell has a child, so the children come in the order of their
+        # parents
+        for level in range(len(levels) - 1):
+            below = levels[level + 1]["codes"]
+            parent = np.cumsum(np.concatenate([[True], (below[1:] >> 2) != (below[:-1] >> 2)])) - 1
+            children = np.full((len(levels[level]["codes"]), 4), -1, dtype=np.int64)
+            children[parent, below & 3] = np.arange(len(below))
+            levels[level]["children"] = children
+
+    def flatten(self, levels):
+        # Every level's cells in one list, root first, for
+        # kernels.tree_accelerations: mass, center, count, code and level of
+        # each cell, the cell width of each level, and four child indexes per
+        # cell into the same list
+        sizes = [len(cells["codes"]) for cells in levels]
+        offsets = np.cumsum([0] + sizes)
+        children = np.full((offsets[-1], 4), -1, dtype=np.int64)
+        for level, cells in enumerate(levels[:-1]):
+            below = cells["children"]
+            children[offsets[level]:offsets[level + 1]] = np.where(below >= 0, below + offsets[level + 1], -1)
+        joined = lambda key: np.concatenate([cells[key] for cells in levels])
+        return (joined("mass"), joined("center_x"), joined("center_y"), joined("count"), joined("codes"),
+                np.repeat(np.arange(len(levels)), sizes), np.array([cells["width"] for cells in levels]), children.ravel())
+
+    def accelerations(self, position_x, position_y, mass, grav_const):
+        number = len(mass)
+        acceleration_x = np.zeros(number)
+        acceleration_y = np.zeros(number)
+        levels = self.build(position_x, position_y, mass)
+        if self.dtype is not np.float64:
+            # Cells in the same dtype and around the same middle as the bodies
+            middle_x = (position_x.min() + position_x.max()) / 2
+            middle_y = (position_y.min() + position_y.max()) / 2
+            position_x, position_y, mass = lowered(self.dtype, position_x, position_y, mass)
+            for cells in levels:
+                cells["center_x"] = (cells["center_x"] - middle_x).astype(self.dtype)
+                cells["center_y"] = (cells["center_y"] - middle_y).astype(self.dtype)
+                cells["mass"] = cells["mass"].astype(self.dtype)
+        if kernels.enabled:
+            kernels.threads_started = True
+            kernels.tree_accelerations(position_x, position_y, mass, levels[0]["key"], levels[0]["order"],
+                                       self.dtype(grav_const), self.dtype(self.softening), self.theta, self.max_depth,
+                                       *self.flatten(levels), acceleration_x, acceleration_y)
+            return cap(self.max_acceleration, acceleration_x, acceleration_y)
+
+        # Every body starts at the root and walks down only where it has to
+        bodies = np.arange(number)
+        nodes = np.zeros(number, dtype=np.int64)
+        for level, cells in enumerate(levels):
+            if len(bodies) == 0:
+                break
+            node_mass = cells["mass"][nodes]
+            count = cells["count"][nodes]
+            center_x = cells["center_x"][nodes]
+            center_y = cells["center_y"][nodes]
+            own = cells["owner"][bodies] == nodes
+
+            # A body never uses its own cell as a whole, at the bottom of the tree
+            # it takes the cell with its own mass removed instead
+            last = level == len(levels) - 1
+            if last:
+                rest = node_mass - mass[bodies] * own
+                center_x = np.where(own, (node_mass * center_x - mass[bodies] * position_x[bodies]) / np.where(rest > 0, rest, 1), center_x)
+                center_y = np.where(own, (node_mass * center_y - mass[bodies] * position_y[bodies]) / np.where(rest > 0, rest, 1), center_y)
+                node_mass = rest
+
+            diff_x = center_x - position_x[bodies]
+            diff_y = center_y - position_y[bodies]
+            distance_sq = diff_x ** 2 + diff_y ** 2
+            accept = ~own & ((count == 1) | (float(cells["width"]) ** 2 < self.theta ** 2 * distance_sq))
+            if last:
+                accept = node_mass > 0
+            accept &= distance_sq > 0
+
+            distance_sq = distance_sq[accept] + self.softening ** 2
+            strength = grav_const * node_mass[accept] / (distance_sq * np.sqrt(distance_sq))
+            acceleration_x += np.bincount(bodies[accept], strength * diff_x[accept], number)
+            acceleration_y += np.bincount(bodies[accept], strength * diff_y[accept], number)
+
+            # Open every cell that was too close (own single-body cells are just the body itself)
+            open_cells = ~accept & (count > 1)
+            if last or not open_cells.any():
+                break
+            children = cells["children"][nodes[open_cells]].ravel()
+            exists = children >= 0
+            bodies = np.repeat(bodies[open_cells], 4)[exists]
+            nodes = children[exists]
+
+        return cap(self.max_acceleration, acceleration_x, acceleration_y)
+
+def fft_size(number):
+    # Smallest 2^a * 3^b at least `number`. numpy's FFT is several times
+    # quicker on these than on sizes with larger prime factors
+    best = 1 << max(number - 1, 0).bit_length()
+    power_of_three = 1
+    while power_of_three < best:
+        size = power_of_three
+        while size < number:
+            size *= 2
+        best = min(best, size)
+        power_of_three *= 3
+    return best
+
+# Particle-mesh: spreads the mass onto a grid over the world with
+# cloud-in-cell weights, gets the field on every grid node with one FFT
+# convolution, and reads it back at each body with the same weights.
+# Cost is O(N + M log M) for M grid nodes, independent of how the bodies
+# are spread out. Forces are accurate beyond a few cells; closer than about
+# two cells they are smoothed out and too weak, so a finer grid is more
+# accurate for close bodies but costs more per step.
+#
+# The simulation's force falls off as 1/r^2 even though the world is flat, so
+# the grid is convolved with that force law directly rather than solving the
+# 2D Poisson equation (whose 1/r force would be different physics). The grid
+# is zero padded to twice its size so gravity does not wrap around the edges.
+class ParticleMeshEngine:
+    name = "particle-mesh"
+
+    # Cells of grid beyond each edge of the world, as a share of its size
+    margin = 0.125
+
+    def __init__(self, world, grid=256, softening=0.0, max_acceleration=None):
+        # grid is the number of cells across the world's width
+        self.world = world
+        self.grid = grid
+        self.softening = softening
+        self.max_acceleration = max_acceleration
+        self.kernels = {}
+        # Exact pulls for the bodies off the grid
+        self.outside = DirectEngine(softening)
+
+    def mesh(self):
+        # The grid covers the world plus `margin` on every side, wherever the
+        # bodies are. With the border off a body flung far away is summed
+        # exactly instead (see mesh_accelerations), so it can't stretch the
+        # cells (and blur the pull) for everyone else
+        cells_x = self.grid
+        cells_y = max(1, int(round(self.grid * self.world[1] / self.world[0])))
+        spacing = float(self.world[0]) / cells_x
+        extra_x = int(np.ceil(self.margin * cells_x))
+        extra_y = int(np.ceil(self.margin * cells_y))
+
+        # One spare node before and two after the box, so every body on it
+        # has all four neighbouring nodes on the grid. Rounded up (on the far
+        # side) to a size the FFT is quick with
+        nodes_x = fft_size(cells_x + 2 * extra_x + 3)
+        nodes_y = fft_size(cells_y + 2 * extra_y + 3)
+        return -(extra_x + 1) * spacing, -(extra_y + 1) * spacing, spacing, nodes_x, nodes_y
+
+    def on_grid(self, position_x, position_y):
+        # Which bodies have all four cloud-in-cell nodes on the grid
+        left, top, spacing, nodes_x, nodes_y = self.mesh()
+        grid_x = (position_x - left) / spacing
+        grid_y = (position_y - top) / spacing
+        return (grid_x >= 0) & (grid_x < nodes_x - 1) & (grid_y >= 0) & (grid_y < nodes_y - 1)
+
+    def weights(self, position_x, position_y, left, top, spacing, nodes_x):
+        # Cloud-in-cell: each body is shared between its four nearest nodes
+        grid_x = (position_x - left) / spacing
+        grid_y = (position_y - top) / spacing
+        node_x = np.floor(grid_x).astype(np.int64)
+        node_y = np.floor(grid_y).astype(np.int64)
+        fraction_x = grid_x - node_x
+        fraction_y = grid_y - node_y
+
+        corner = node_y * nodes_x + node_x
+        index = np.stack([corner, corner + 1, corner + nodes_x, corner + nodes_x + 1])
+        weight = np.stack([
+            (1 - fraction_x) * (1 - fraction_y),
+            fraction_x * (1 - fraction_y),
+            (1 - fraction_x) * fraction_y,
+            fraction_x * fraction_y,
+        ])
+        return index, weight
+
+    def kernel(self, nodes_x, nodes_y, spacing):
+        # Fourier transform of the pull of one unit of mass (G = 1) on the
+        # padded grid, kept between steps while the grid stays the same
+        key = (nodes_x, nodes_y, spacing)
+        if key not in self.kernels:
+            offset_x = np.fft.fftfreq(2 * nodes_x, 1.0 / (2 * nodes_x))
+            offset_y = np.fft.fftfreq(2 * nodes_y, 1.0 / (2 * nodes_y))
+            diff_x = offset_x[np.newaxis, :] * spacing
+            diff_y = offset_y[:, np.newaxis] * spacing
+            distance = np.sqrt(diff_x ** 2 + diff_y ** 2)
+            distance[0, 0] = np.inf
+            strength = self.long_range(distance, spacing) / (distance ** 2 + self.softening ** 2) ** 1.5
+
+            # A node at offset d from the mass is pulled back along -d
+            self.kernels = {key: (np.fft.rfft2(-diff_x * strength), np.fft.rfft2(-diff_y * strength))}
+        return self.kernels[key]
+
+    def long_range(self, distance, spacing):
+        # Share of the force the mesh is responsible for (all of it here)
+        return 1.0
+
+    def field(self, grid_mass, nodes_x, nodes_y, spacing):
+        # Acceleration on every grid node (for G = 1)
+        kernel_x, kernel_y = self.kernel(nodes_x, nodes_y, spacing)
+        shape = (2 * nodes_y, 2 * nodes_x)
+        mass_hat = np.fft.rfft2(grid_mass, shape)
+        field_x = np.fft.irfft2(mass_hat * kernel_x, shape)[:nodes_y, :nodes_x]
+        field_y = np.fft.irfft2(mass_hat * kernel_y, shape)[:nodes_y, :nodes_x]
+        return field_x, field_y
+
+    def accelerations(self, position_x, position_y, mass, grav_const):
+        return cap(self.max_acceleration, *self.mesh_accelerations(position_x, position_y, mass, grav_const)[:2])
+
+    def mesh_accelerations(self, position_x, position_y, mass, grav_const):
+        # Pull between two bodies on the grid through the mesh, exact for
+        # every pair with a body off it. Also returns which bodies are on it
+        number = len(mass)
+        acceleration_x = np.zeros(number)
+        acceleration_y = np.zeros(number)
+        inside = self.on_grid(position_x, position_y)
+        on = np.flatnonzero(inside)
+        off = np.flatnonzero(~inside)
+
+        if len(on):
+            left, top, spacing, nodes_x, nodes_y = self.mesh()
+            index, weight = self.weights(position_x[on], position_y[on], left, top, spacing, nodes_x)
+            grid_mass = np.bincount(index.ravel(), (weight * mass[on]).ravel(), nodes_x * nodes_y)
+            field_x, field_y = self.field(grid_mass.reshape(nodes_y, nodes_x), nodes_x, nodes_y, spacing)
+            acceleration_x[on] = grav_const * (field_x.ravel()[index] * weight).sum(axis=0)
+            acceleration_y[on] = grav_const * (field_y.ravel()[index] * weight).sum(axis=0)
+
+        if len(off):
+            # Everyone's pull on the bodies off the grid, and theirs on the rest
+            acceleration_x[off], acceleration_y[off] = self.outside.accelerations(position_x, position_y, mass, grav_const, off)
+            if len(on):
+                pull_x, pull_y = direct_pull(position_x[on], position_y[on], position_x[off], position_y[off], mass[off],
+                                             grav_const, self.softening)
+                acceleration_x[on] += pull_x
+                acceleration_y[on] += pull_y
+        return acceleration_x, acceleration_y, inside
+
+def direct_pull(target_x, target_y, source_x, source_y, source_mass, grav_const, softening, batch=1 << 20):
+    # Exact pull of a few source bodies on each target (none from a source
+    # sitting right on it), in blocks of about `batch` pairs
+    acceleration_x = np.zeros(len(target_x))
+    acceleration_y = np.zeros(len(target_x))
+    rows = max(1, batch // max(len(source_x), 1))
+    for start in range(0, len(target_x), rows):
+        diff_x = source_x - target_x[start:start + rows, np.newaxis]
+        diff_y = source_y - target_y[start:start + rows, np.newaxis]
+        distance_sq = diff_x ** 2 + diff_y ** 2
+        distance_sq[distance_sq == 0] = np.inf
+        distance_sq += softening ** 2
+        strength = grav_const * source_mass / (distance_sq * np.sqrt(distance_sq))
+        acceleration_x[start:start + rows] = (strength * diff_x).sum(axis=1)
+        acceleration_y[start:start + rows] = (strength * diff_y).sum(axis=1)
+    return acceleration_x, acceleration_y
+
+def neighbour_pairs(position_x, position_y, reach, symmetric=True, batch=1 << 20):
+    # Pairs (i array, j array) of bodies in the same or touching cells of a grid
+    # with cells `reach` wide: a superset of the pairs closer than reach.
+    # With symmetric each unordered pair comes once (only half of the
+    # neighbouring cells are looked at), otherwise as both (i, j) and (j, i).
+    # Yielded in batches of about `batch` pairs so dense clouds don't need
+    # all of them in memory at once
+    cell_x = np.floor(position_x / reach).astype(np.int64)
+    cell_y = np.floor(position_y / reach).astype(np.int64)
+    cell_x -= cell_x.min()
+    cell_y -= cell_y.min()
+    # Wide enough that stepping one cell left or right never wraps a row
+    width = cell_x.max() + 3
+    key = (cell_y + 1) * width + (cell_x + 1)
+    order = np.argsort(key, kind="stable")
+    sorted_key = key[order]
+
+    if symmetric:
+        offsets = [(0, 0), (1, 0), (-1, 1), (0, 1), (1, 1)]
+    else:
+        offsets = [(offset_x, offset_y) for offset_y in (-1, 0, 1) for offset_x in (-1, 0, 1)]
+    for offset_x, offset_y in offsets:
+        # Slice of the sorted bodies that sit in the neighbouring cell
+        target = key + offset_y * width + offset_x
+        start = np.searchsorted(sorted_key, target, "left")
+        count = np.searchsorted(sorted_key, target, "right") - start
+
+        total = np.cumsum(count)
+        cuts = [0] + list(np.searchsorted(total, np.arange(batch, total[-1], batch))) + [len(key)]
+        for low, high in zip(cuts[:-1], cuts[1:]):
+            if low == high:
+                continue
+            part = count[low:high]
+            first = np.repeat(np.arange(low, high), part)
+            step = np.arange(part.sum()) - np.repeat(np.cumsum(part) - part, part)
+            second = order[np.repeat(start[low:high], part) + step]
+            # Within one cell, (i, j) and (j, i) both show up
+            if symmetric and offset_x == 0 and offset_y == 0:
+                keep = first < second
+            else:
+                keep = first != second
+            yield first[keep], second[keep]
+
+def pair_sum(position_x, position_y, mass, reach, pull, symmetric=True, deterministic=False):
+    # Direct sum over neighbour_pairs. pull(distance) is the acceleration per
+    # unit of mass and distance (G / r^3 for plain gravity).
+    # symmetric works each pair out once and pulls both bodies with it
+    # (Newton's third law), halving the square roots.
+    # deterministic adds up each body's pulls in order of the other body's
+    # index, so the result is the same to the last bit whatever order the
+    # pairs came in (symmetric or not, any batch size)
+    number = len(mass)
+    acceleration_x = np.zeros(number)
+    acceleration_y = np.zeros(number)
+    kept = []
+    for first, second in neighbour_pairs(position_x, position_y, reach, symmetric):
+        diff_x = position_x[second] - position_x[first]
+        diff_y = position_y[second] - position_y[first]
+        distance = np.sqrt(diff_x ** 2 + diff_y ** 2)
+        near = distance > 0
+        first = first[near]
+        second = second[near]
+        diff_x = diff_x[near]
+        diff_y = diff_y[near]
+        strength = pull(distance[near])
+
+        # first is pulled toward second, and (symmetric) second toward first
+        targets = [first]
+        partners = [second]
+        pulls_x = [strength * mass[second] * diff_x]
+        pulls_y = [strength * mass[second] * diff_y]
+        if symmetric:
+            targets.append(second)
+            partners.append(first)
+            pulls_x.append(-(strength * mass[first] * diff_x))
+            pulls_y.append(-(strength * mass[first] * diff_y))
+        targets = np.concatenate(targets)
+        pulls_x = np.concatenate(pulls_x)
+        pulls_y = np.concatenate(pulls_y)
+
+        if deterministic:
+            kept.append((targets, np.concatenate(partners), pulls_x, pulls_y))
+        else:
+            acceleration_x += np.bincount(targets, pulls_x, number)
+            acceleration_y += np.bincount(targets, pulls_y, number)
+
+    if deterministic and kept:
+        targets, partners, pulls_x, pulls_y = [np.concatenate(part) for part in zip(*kept)]
+        order = np.lexsort((partners, targets))
+        acceleration_x = np.bincount(targets[order], pulls_x[order], number)
+        acceleration_y = np.bincount(targets[order], pulls_y[order], number)
+    return acceleration_x, acceleration_y
+
+# P3M (particle-particle particle-mesh): the force is split at `cutoff` grid
+# cells. Beyond it everything comes from the mesh, which handles a smooth,
+# long range part well. Below it the rest is summed exactly over pairs found
+# with a cell list. The exact sum carries over 90% of the pull within 2 cells
+# and most of it within half the cutoff, so there the pull between two bodies
+# is within 0.5% (2 cells, where bodies collide) and 1.5% (half the cutoff)
+# of the direct engine's, with the default cutoff of 8 (benchmark.py p3m
+# checks this). Close to O(N) while the number of bodies within the cutoff of
+# each body stays small.
+class P3MEngine(ParticleMeshEngine):
+    name = "p3m"
+
+    def __init__(self, world, grid=256, cutoff=8, symmetric=True, deterministic=False, softening=0.0, max_acceleration=None):
+        ParticleMeshEngine.__init__(self, world, grid, softening, max_acceleration)
+        self.cutoff = cutoff
+        # How the exact pairs are summed, see pair_sum()
+        self.symmetric = symmetric
+        self.deterministic = deterministic
+
+    def split(self, distance, reach):
+        # Goes smoothly from 0 at distance 0 to 1 at reach and beyond (a
+        # "smootherstep"), flat at both ends so the mesh part has no kinks
+        ratio = np.minimum(distance / reach, 1.0)
+        return ratio ** 3 * (10 - 15 * ratio + 6 * ratio ** 2)
+
+    def long_range(self, distance, spacing):
+        return self.split(distance, self.cutoff * spacing)
+
+    def kernel(self, nodes_x, nodes_y, spacing):
+        key = (nodes_x, nodes_y, spacing)
+        if key not in self.kernels:
+            kernel_x, kernel_y = ParticleMeshEngine.kernel(self, nodes_x, nodes_y, spacing)
+            # Undo the blurring of cloud-in-cell, once for spreading the mass and
+            # once for reading the field back. Safe here because the long range
+            # part is smooth (for plain PM it would amplify grid noise)
+            frequency_x = np.fft.rfftfreq(2 * nodes_x)
+            frequency_y = np.fft.fftfreq(2 * nodes_y)
+            window = (np.sinc(frequency_x)[np.newaxis, :] * np.sinc(frequency_y)[:, np.newaxis]) ** 4
+            self.kernels = {key: (kernel_x / window, kernel_y / window)}
+        return self.kernels[key]
+
+    def accelerations(self, position_x, position_y, mass, grav_const):
+        acceleration_x, acceleration_y, inside = self.mesh_accelerations(position_x, position_y, mass, grav_const)
+
+        # Short range part: what the mesh left out, for pairs within the
+        # cutoff (pairs with a body off the grid were summed exactly already)
+        on = np.flatnonzero(inside)
+        reach = self.cutoff * self.mesh()[2]
+        pull = lambda distance: grav_const * (1 - self.split(distance, reach)) / (distance ** 2 + self.softening ** 2) ** 1.5
+        if len(on):
+            near_x, near_y = pair_sum(position_x[on], position_y[on], mass[on], reach, pull, self.symmetric, self.deterministic)
+            acceleration_x[on] += near_x
+            acceleration_y[on] += near_y
+        return cap(self.max_acceleration, acceleration_x, acceleration_y)
+
+# Fast multipole method: a uniform quadtree where every cell keeps a
+# multipole expansion of the mass inside it, far cells hand their pull to
+# each other as local expansions (instead of to every body), and only
+# bodies in touching leaf cells are summed directly. O(N) per step.
+#
+# The usual complex 2D FMM expands log|z|, whose 1/r force is not the one
+# used here. Instead the 1/r potential is written as (z * conj(z))^(-1/2) and
+# expanded in powers of both z and conj(z), so expansions are still complex
+# numbers per cell. `order` is the highest power kept: the error falls by
+# roughly half for every extra order, while the cost grows with order^2
+# (order^4 for the cell to cell step).
+# Works best when the bodies fill their bounding box; a body far away from
+# everything else makes the leaf cells large and the direct part slow.
+class FastMultipoleEngine:
+    name = "fmm"
+
+    def __init__(self, order=6, leaf_size=16, symmetric=True, deterministic=False, softening=0.0, max_acceleration=None):
+        self.order = order
+        # Average bodies per leaf cell, trades direct sums against expansions
+        self.leaf_size = leaf_size
+        # How the pairs in touching leaves are summed, see pair_sum()
+        self.symmetric = symmetric
+        self.deterministic = deterministic
+        # Softening only changes the direct part, the expansions assume
+        # leaves that don't touch are much further apart than `softening`
+        self.softening = softening
+        self.max_acceleration = max_acceleration
+        self.terms = [(a, n - a) for n in range(order + 1) for a in range(n + 1)]
+        self.factorial = [math.factorial(n) for n in range(2 * order + 2)]
+        self.transfers = {}
+
+    def derivative(self, a, b, offset):
+        # a-th z and b-th conj(z) derivative of |z|^-1 at offset:
+        # k_a k_b |z|^-1 z^-a conj(z)^-b, with k_n = (-1)^n (2n)! / (4^n n!)
+        k_a = (-1) ** a * self.factorial[2 * a] / (4 ** a * self.factorial[a])
+        k_b = (-1) ** b * self.factorial[2 * b] / (4 ** b * self.factorial[b])
+        return k_a * k_b / abs(offset) * offset ** -a * offset.conjugate() ** -b
+
+    def shift_multipole(self, offset):
+        # Moves a multipole expansion to a center `offset` further in (child to parent)
+        matrix = np.zeros((len(self.terms), len(self.terms)), dtype=complex)
+        for row, (a, b) in enumerate(self.terms):
+            for column, (c, d) in enumerate(self.terms):
+                if c <= a and d <= b:
+                    matrix[row, column] = offset ** (a - c) * offset.conjugate() ** (b - d) / (self.factorial[a - c] * self.factorial[b - d])
+        return matrix
+
+    def shift_local(self, offset):
+        # Moves a local expansion to a center `offset` away (parent to child)
+        matrix = np.zeros((len(self.terms), len(self.terms)), dtype=complex)
+        for row, (c, d) in enumerate(self.terms):
+            for column, (a, b) in enumerate(self.terms):
+                if a >= c and b >= d:
+                    choose = math.comb(a, c) * math.comb(b, d)
+                    matrix[row, column] = choose * offset ** (a - c) * offset.conjugate() ** (b - d)
+        return matrix
+
+    def multipole_to_local(self, offset):
+        # Local expansion (about the target cell) of a multipole expansion
+        # sitting `offset` away from it, for G = 1
+        matrix = np.zeros((len(self.terms), len(self.terms)), dtype=complex)
+        for row, (c, d) in enumerate(self.terms):
+            for column, (a, b) in enumerate(self.terms):
+                if a + b + c + d <= self.order:
+                    sign = (-1) ** (a + b)
+                    matrix[row, column] = -sign * self.derivative(a + c, b + d, offset) / (self.factorial[c] * self.factorial[d])
+        return matrix
+
+    def transfer(self, kind, offset):
+        # Transfer matrices depend only on the offset between cells. Offsets are
+        # measured with the box as one unit, so they repeat every step
+        key = (kind, offset)
+        if key not in self.transfers:
+            if kind == "multipole":
+                self.transfers[key] = self.shift_multipole(offset)
+            elif kind == "local":
+                self.transfers[key] = self.shift_local(offset)
+            else:
+                self.transfers[key] = self.multipole_to_local(offset)
+        return self.transfers[key]
+
+    def accelerations(self, position_x, position_y, mass, grav_const):
+        number = len(mass)
+        depth = max(2, int(math.ceil(math.log(max(number, 1) / self.leaf_size, 4))))
+        cells = 2 ** depth
+
+        # Square box around every body, split into cells x cells leaves
+        left = position_x.min()
+        top = position_y.min()
+        width = max(position_x.max() - left, position_y.max() - top) * (1 + 1e-9) or 1.0
+        leaf_width = width / cells
+        leaf_x = np.floor((position_x - left) / leaf_width).astype(np.int64)
+        leaf_y = np.floor((position_y - top) / leaf_width).astype(np.int64)
+        leaf = leaf_y * cells + leaf_x
+
+        # Expansions work in box units (the box is 1 wide), position in the leaf
+        spread = ((position_x - left) / width - (leaf_x + 0.5) / cells) + 1j * ((position_y - top) / width - (leaf_y + 0.5) / cells)
+
+        # Multipole expansion of each leaf: sum of m s^a conj(s)^b / (a! b!)
+        multipoles = [None] * (depth + 1)
+        leaf_multipole = np.zeros((cells * cells, len(self.terms)), dtype=complex)
+        for column, (a, b) in enumerate(self.terms):
+            value = mass * spread ** a * spread.conjugate() ** b / (self.factorial[a] * self.factorial[b])
+            leaf_multipole[:, column] = np.bincount(leaf, value.real, cells * cells) + 1j * np.bincount(leaf, value.imag, cells * cells)
+        multipoles[depth] = leaf_multipole.reshape(cells, cells, len(self.terms))
+
+        # Upward pass: parents collect their four children
+        for level in range(depth - 1, 1, -1):
+            size = 2 ** level
+            child_width = 1.0 / (2 * size)
+            parent = np.zeros((size, size, len(self.terms)), dtype=complex)
+            for quadrant_y in (0, 1):
+                for quadrant_x in (0, 1):
+                    offset = complex(quadrant_x - 0.5, quadrant_y - 0.5) * child_width
+                    child = multipoles[level + 1][quadrant_y::2, quadrant_x::2]
+                    parent += child @ self.transfer("multipole", offset).T
+            multipoles[level] = parent
+
+        # Interaction lists: children of the parent's neighbours that don't touch the cell
+        locals_ = [None] * (depth + 1)
+        for level in range(2, depth + 1):
+            size = 2 ** level
+            cell_width = 1.0 / size
+            local = np.zeros((size, size, len(self.terms)), dtype=complex)
+            if level > 2:
+                # Start from the parent's local expansion, moved to this cell's center
+                for quadrant_y in (0, 1):
+                    for quadrant_x in (0, 1):
+                        offset = complex(quadrant_x - 0.5, quadrant_y - 0.5) * cell_width
+                        local[quadrant_y::2, quadrant_x::2] = locals_[level - 1] @ self.transfer("local", offset).T
+
+            # Padded with three empty cells on each side so offsets never leave the array
+            padded = np.zeros((size + 6, size + 6, len(self.terms)), dtype=complex)
+            padded[3:-3, 3:-3] = multipoles[level]
+            for parity_y in (0, 1):
+                for parity_x in (0, 1):
+                    target = local[parity_y::2, parity_x::2]
+                    for offset_y in range(-2 - parity_y, 4 - parity_y):
+                        for offset_x in range(-2 - parity_x, 4 - parity_x):
+                            if abs(offset_x) <= 1 and abs(offset_y) <= 1:
+                                continue
+                            start_y = parity_y + offset_y + 3
+                            start_x = parity_x + offset_x + 3
+                            source = padded[start_y:start_y + size:2, start_x:start_x + size:2]
+                            # The local expansion sits at the target, the multipole at target + offset
+                            matrix = self.transfer("m2l", complex(-offset_x, -offset_y) * cell_width)
+                            target += source @ matrix.T
+            locals_[level] = local
+
+        # Far field: -grad(potential) = -2 d(potential)/d(conj z) of each body's leaf expansion
+        leaf_local = locals_[depth].reshape(cells * cells, len(self.terms))[leaf]
+        field = np.zeros(number, dtype=complex)
+        for column, (c, d) in enumerate(self.terms):
+            if d > 0:
+                field -= 2 * d * leaf_local[:, column] * spread ** c * spread.conjugate() ** (d - 1)
+        # Back from box units: the pull scales with 1 / width^2
+        acceleration_x = field.real / width ** 2
+        acceleration_y = field.imag / width ** 2
+
+        # Near field: direct sum over bodies in the same or touching leaves
+        pull = lambda distance: 1 / (distance ** 2 + self.softening ** 2) ** 1.5
+        near_x, near_y = pair_sum(position_x - left, position_y - top, mass, leaf_width, pull, self.symmetric, self.deterministic)
+        acceleration_x += near_x
+        acceleration_y += near_y
+
+        return cap(self.max_acceleration, grav_const * acceleration_x, grav_const * acceleration_y)
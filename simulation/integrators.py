@@ -0,0 +1,260 @@
+'''
+Integrators
+----------------------------
+Ways of moving a ParticleSet forward by one step of dt seconds once the
+collisions are done. Each one calls the force engine for the accelerations.
+'''
+import math
+
+import numpy as np
+
+from engines import DirectEngine, neighbour_pairs
+
+# The original scheme: velocity gets the whole step's pull, then the
+# position moves with the new velocity. First order, so it needs small
+# steps to keep orbits from drifting
+class EulerIntegrator:
+    name = "euler"
+
+    def step(self, particles, engine, grav_const, dt, border, size):
+        particles.apply_gravity(engine, grav_const, dt)
+        particles.calculate_new_position(border, size, dt)
+
+# Leapfrog in kick-drift-kick form (same as velocity Verlet): half a kick,
+# a full drift, then the other half kick with the pull at the new positions.
+# Second order and symplectic, so energy doesn't drift away over long runs
+# and steps can be several times larger than with Euler for the same error.
+# Still one force evaluation per step: the pull at the end of a step is
+# kept for the start of the next one
+class LeapfrogIntegrator:
+    name = "leapfrog"
+
+    def __init__(self):
+        # What the kept accelerations were worked out for
+        self.id = None
+        self.grav_const = None
+
+    def step(self, particles, engine, grav_const, dt, border, size):
+        # New or merged bodies (remove_merged gives the set a new id array)
+        # or a flipped G need a fresh pull to start from
+        if particles.id is not self.id or grav_const != self.grav_const:
+            particles.calculate_acceleration(engine, grav_const)
+        particles.kick(dt / 2)
+        particles.calculate_new_position(border, size, dt)
+        particles.calculate_acceleration(engine, grav_const)
+        particles.kick(dt / 2)
+        self.id = particles.id
+        self.grav_const = grav_const
+
+# 4th order Hermite predictor-corrector: predicts positions and velocities
+# from the acceleration and jerk (rate of change of acceleration) at the
+# start of the step, works both out again at the predicted state, then
+# corrects with the two. Error falls with dt^4, so long orbit runs reach
+# the same accuracy as leapfrog in far fewer steps. Needs the jerk, which
+# only the direct engine works out
+class HermiteIntegrator:
+    name = "hermite"
+
+    def __init__(self):
+        self.id = None
+        self.grav_const = None
+
+    def evaluate(self, particles, engine, grav_const, position_x, position_y, velocity_x, velocity_y):
+        # Acceleration and jerk of the live bodies at the given state
+        live = ~particles.merged
+        acceleration_x = np.zeros(len(particles))
+        acceleration_y = np.zeros(len(particles))
+        jerk_x = np.zeros(len(particles))
+        jerk_y = np.zeros(len(particles))
+        acceleration_x[live], acceleration_y[live], jerk_x[live], jerk_y[live] = engine.accelerations_and_jerks(
+            position_x[live], position_y[live], velocity_x[live], velocity_y[live], particles.mass[live], grav_const)
+        return acceleration_x, acceleration_y, jerk_x, jerk_y
+
+    def step(self, particles, engine, grav_const, dt, border, size):
+        if particles.id is not self.id or grav_const != self.grav_const:
+            particles.acceleration_x, particles.acceleration_y, self.jerk_x, self.jerk_y = self.evaluate(
+                particles, engine, grav_const, particles.position_x, particles.position_y, particles.velocity_x, particles.velocity_y)
+        acceleration_x, acceleration_y = particles.acceleration_x, particles.acceleration_y
+        jerk_x, jerk_y = self.jerk_x, self.jerk_y
+
+        # Predict (Taylor series up to the jerk)
+        predicted_x = particles.position_x + dt * (particles.velocity_x + dt * (acceleration_x / 2 + dt * jerk_x / 6))
+        predicted_y = particles.position_y + dt * (particles.velocity_y + dt * (acceleration_y / 2 + dt * jerk_y / 6))
+        predicted_velocity_x = particles.velocity_x + dt * (acceleration_x + dt * jerk_x / 2)
+        predicted_velocity_y = particles.velocity_y + dt * (acceleration_y + dt * jerk_y / 2)
+
+        # Evaluate at the predicted state
+        new_x, new_y, new_jerk_x, new_jerk_y = self.evaluate(particles, engine, grav_const, predicted_x, predicted_y,
+                                                              predicted_velocity_x, predicted_velocity_y)
+
+        # Correct
+        velocity_x = particles.velocity_x + dt * (acceleration_x + new_x) / 2 + dt * dt * (jerk_x - new_jerk_x) / 12
+        velocity_y = particles.velocity_y + dt * (acceleration_y + new_y) / 2 + dt * dt * (jerk_y - new_jerk_y) / 12
+        particles.position_x += dt * (particles.velocity_x + velocity_x) / 2 + dt * dt * (acceleration_x - new_x) / 12
+        particles.position_y += dt * (particles.velocity_y + velocity_y) / 2 + dt * dt * (acceleration_y - new_y) / 12
+        particles.velocity_x[:] = velocity_x
+        particles.velocity_y[:] = velocity_y
+        if border:
+            particles.bounce(size)
+
+        particles.acceleration_x, particles.acceleration_y = new_x, new_y
+        self.jerk_x, self.jerk_y = new_jerk_x, new_jerk_y
+        self.id = particles.id
+        self.grav_const = grav_const
+
+# Picks one dt for all bodies before each step: the smallest of
+# `accuracy` * sqrt(r / |a|) over pairs of nearby bodies, with r how far
+# apart they are and |a| how hard they pull on each other, and of the time
+# until any two bodies would touch at the speed they are closing in at.
+# Steps stay at `largest` while the bodies are far apart and only shrink
+# during close encounters
+class AdaptiveTimestep:
+    # Up to this many bodies every pair is checked
+    all_pairs = 256
+
+    def __init__(self, largest=1.0, accuracy=0.1, smallest=None, crossing=False, softening=0.0, max_acceleration=None):
+        self.largest = largest
+        self.accuracy = accuracy
+        self.smallest = largest / 1000 if smallest is None else smallest
+        # Also limit a pair to the time they take to move their distance
+        # apart (and so change their pull a lot), see BlockTimestepIntegrator
+        self.crossing = crossing
+        # The engine's limits on close encounters (see engines.py), so a
+        # softened or capped pull doesn't ask for tiny steps
+        self.softening = softening
+        self.max_acceleration = max_acceleration
+
+    def choose(self, particles, grav_const):
+        return np.min(self.body_steps(particles, grav_const), initial=self.largest)
+
+    def body_steps(self, particles, grav_const):
+        # The step each live body could take by itself: both bodies of a
+        # pair get the pair's limit
+        live = np.flatnonzero(~particles.merged)
+        steps = np.full(len(live), float(self.largest))
+        if len(live) < 2:
+            return steps
+        position_x = particles.position_x[live]
+        position_y = particles.position_y[live]
+        velocity_x = particles.velocity_x[live]
+        velocity_y = particles.velocity_y[live]
+        mass = particles.mass[live]
+        radius = particles.radius[live]
+
+        # Encounters are only looked for within a few times the mean spacing
+        # (few enough bodies just check every pair). The spacing comes from
+        # the middle 90% of the bodies along each axis, so a few that escaped
+        # far away don't make the cells so big that every pair shares one
+        if len(live) <= self.all_pairs:
+            pairs = [np.triu_indices(len(live), 1)]
+        else:
+            low_x, high_x = np.percentile(position_x, (5, 95))
+            low_y, high_y = np.percentile(position_y, (5, 95))
+            spread = max(high_x - low_x, high_y - low_y, 0.9) / 0.9
+            pairs = neighbour_pairs(position_x, position_y, 2 * spread / math.sqrt(len(live)))
+        for first, second in pairs:
+            diff_x = position_x[second] - position_x[first]
+            diff_y = position_y[second] - position_y[first]
+            distance = np.sqrt(diff_x ** 2 + diff_y ** 2)
+            apart = distance > 0
+            if not apart.any():
+                continue
+            first, second, diff_x, diff_y, distance = first[apart], second[apart], diff_x[apart], diff_y[apart], distance[apart]
+
+            # sqrt(r / |a|) with the pull of the two on each other
+            pull = abs(grav_const) * (mass[first] + mass[second]) * distance / (distance ** 2 + self.softening ** 2) ** 1.5
+            if self.max_acceleration is not None:
+                pull = np.minimum(pull, 2 * self.max_acceleration)
+            limit = self.accuracy * np.sqrt(distance / pull)
+            relative_x = velocity_x[second] - velocity_x[first]
+            relative_y = velocity_y[second] - velocity_y[first]
+            if self.crossing:
+                speed = np.sqrt(relative_x ** 2 + relative_y ** 2)
+                moving = speed > 0
+                limit[moving] = np.minimum(limit[moving], self.accuracy * distance[moving] / speed[moving])
+
+            # Speed the two are closing in at, and the gap between their edges
+            closing = -(relative_x * diff_x + relative_y * diff_y) / distance
+            gap = distance - radius[first] - radius[second]
+            approaching = (closing > 0) & (gap > 0)
+            limit[approaching] = np.minimum(limit[approaching], gap[approaching] / closing[approaching])
+
+            np.minimum.at(steps, first, limit)
+            np.minimum.at(steps, second, limit)
+        return np.maximum(steps, self.smallest)
+
+# Block timesteps: leapfrog where every body gets its own step, dt / 2^level
+# with the level picked from AdaptiveTimestep.body_steps at the start of
+# each step of dt. All bodies drift together, but a body only gets its pull
+# worked out (and its kick) at the end of its own step, so bodies far from
+# any encounter cost one force evaluation per dt however small the steps in
+# a tight cluster get. Only the direct engine can work out the pull on a few
+# bodies by themselves, other engines do all of them and keep the ones needed.
+# Steps are also kept short enough for the pull of fast moving bodies (like
+# a tight pair going round) to be followed by slow ones further out
+class BlockTimestepIntegrator:
+    name = "block"
+
+    def __init__(self, accuracy=0.1, levels=10):
+        self.accuracy = accuracy
+        self.levels = levels
+        # Accelerations worked out for one body count as one evaluation
+        self.evaluations = 0
+        self.id = None
+        self.grav_const = None
+
+    def accelerate(self, particles, engine, grav_const, live, active):
+        # New accelerations of the bodies live[active], pulled by all live ones
+        position_x = particles.position_x[live]
+        position_y = particles.position_y[live]
+        mass = particles.mass[live]
+        if isinstance(engine, DirectEngine):
+            acceleration_x, acceleration_y = engine.accelerations(position_x, position_y, mass, grav_const, active)
+        else:
+            acceleration_x, acceleration_y = engine.accelerations(position_x, position_y, mass, grav_const)
+            acceleration_x, acceleration_y = acceleration_x[active], acceleration_y[active]
+        particles.acceleration_x[live[active]] = acceleration_x
+        particles.acceleration_y[live[active]] = acceleration_y
+        self.evaluations += len(active)
+
+    def step(self, particles, engine, grav_const, dt, border, size):
+        live = np.flatnonzero(~particles.merged)
+        if len(live) == 0:
+            return
+        everyone = np.arange(len(live))
+        if particles.id is not self.id or grav_const != self.grav_const:
+            self.accelerate(particles, engine, grav_const, live, everyone)
+
+        # Level of every body: the largest dt / 2^level that fits its own step
+        timestep = AdaptiveTimestep(dt, self.accuracy, dt / 2 ** self.levels, crossing=True,
+                                    softening=engine.softening, max_acceleration=engine.max_acceleration)
+        own = timestep.body_steps(particles, grav_const)
+        level = np.clip(np.ceil(np.log2(dt / own)), 0, self.levels).astype(np.int64)
+
+        # Time is counted in ticks of the smallest step in use, each body's
+        # step is `span` ticks long
+        top = level.max()
+        tick = dt / 2 ** top
+        span = 2 ** (top - level)
+        spans = np.unique(span)
+
+        # Opening half kick of everyone, then drift to the next end of a
+        # step, kick the bodies whose step ends there, and so on
+        particles.velocity_x[live] += particles.acceleration_x[live] * (span * tick / 2)
+        particles.velocity_y[live] += particles.acceleration_y[live] * (span * tick / 2)
+        now = 0
+        while now < 2 ** top:
+            later = (now // spans[0] + 1) * spans[0]
+            particles.calculate_new_position(border, size, (later - now) * tick)
+            now = later
+            active = everyone[now % span == 0]
+            self.accelerate(particles, engine, grav_const, live, active)
+
+            # Closing half kick, plus the opening half of the next step
+            kick = span[active] * tick / 2
+            if now < 2 ** top:
+                kick *= 2
+            particles.velocity_x[live[active]] += particles.acceleration_x[live[active]] * kick
+            particles.velocity_y[live[active]] += particles.acceleration_y[live[active]] * kick
+        self.id = particles.id
+        self.grav_const = grav_const
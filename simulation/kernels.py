@@ -0,0 +1,269 @@
+'''
+Compiled Kernels
+----------------------------
+Plain loops over the ParticleSet arrays for the all-pairs work (direct sum
+gravity and the brute force collision pass), the Barnes-Hut tree walk and
+the grid collision pass, compiled with numba when it is installed. They skip
+the large temporary arrays of the numpy versions and give the same results
+(to rounding where the pulls are added up in another order: the tree walk,
+and the direct sums that take each pair once). Compiled code is cached on
+disk (in __pycache__), so only the first launch pays for compiling.
+
+Without numba `enabled` is False and the engines and ParticleSet keep using
+their numpy code.
+'''
+import math
+
+import numpy as np
+
+try:
+    import numba
+except ImportError:
+    numba = None
+
+# Whether the engines and ParticleSet use these kernels (main.py's --no-jit
+# and the benchmarks turn it off)
+enabled = numba is not None
+
+# Set by the engines before they first run a parallel_jit kernel: numba's
+# threads are running from then on, and a process forked after that hangs
+# at exit (see ParallelEngine)
+threads_started = False
+
+# nogil lets several threads run a kernel at once (see ThreadedEngine).
+# parallel_jit kernels split their prange loops over every core themselves
+if numba is not None:
+    jit = numba.njit(cache=True, nogil=True)
+    parallel_jit = numba.njit(cache=True, nogil=True, parallel=True)
+    prange = numba.prange
+else:
+    def jit(function):
+        return function
+    parallel_jit = jit
+    prange = range
+
+@jit
+def direct_accelerations(position_x, position_y, mass, grav_const, softening, targets, acceleration_x, acceleration_y):
+    # Same as DirectEngine.accelerations, one row (target body) at a time,
+    # into the acceleration arrays
+    for row in range(len(targets)):
+        i = targets[row]
+        acceleration_x[row] = 0
+        acceleration_y[row] = 0
+        for j in range(len(mass)):
+            diff_x = position_x[j] - position_x[i]
+            diff_y = position_y[j] - position_y[i]
+            distance_sq = diff_x * diff_x + diff_y * diff_y
+            if distance_sq == 0:
+                continue
+            distance_sq += softening * softening
+            strength = grav_const * mass[j] / (distance_sq * math.sqrt(distance_sq))
+            acceleration_x[row] += strength * diff_x
+            acceleration_y[row] += strength * diff_y
+
+@jit
+def direct_accelerations_all(position_x, position_y, mass, grav_const, softening, acceleration_x, acceleration_y):
+    # direct_accelerations for every body in order: each pair once (j > i),
+    # with equal and opposite pulls (Newton's third law), so half the work
+    number = len(mass)
+    for i in range(number):
+        acceleration_x[i] = 0
+        acceleration_y[i] = 0
+    for i in range(number):
+        x = position_x[i]
+        y = position_y[i]
+        own_x = 0.0
+        own_y = 0.0
+        for j in range(i + 1, number):
+            diff_x = position_x[j] - x
+            diff_y = position_y[j] - y
+            distance_sq = diff_x * diff_x + diff_y * diff_y
+            if distance_sq == 0:
+                continue
+            distance_sq += softening * softening
+            strength = grav_const / (distance_sq * math.sqrt(distance_sq))
+            own_x += strength * mass[j] * diff_x
+            own_y += strength * mass[j] * diff_y
+            acceleration_x[j] -= strength * mass[i] * diff_x
+            acceleration_y[j] -= strength * mass[i] * diff_y
+        acceleration_x[i] += own_x
+        acceleration_y[i] += own_y
+
+@jit
+def tile_accelerations(position_x, position_y, mass, grav_const, softening, targets, columns, out_x, out_y):
+    # The pull of bodies columns[0] to columns[1] on each of targets, into
+    # out (one tile of ThreadedEngine)
+    for row in range(len(targets)):
+        i = targets[row]
+        sum_x = 0.0
+        sum_y = 0.0
+        for j in range(columns[0], columns[1]):
+            diff_x = position_x[j] - position_x[i]
+            diff_y = position_y[j] - position_y[i]
+            distance_sq = diff_x * diff_x + diff_y * diff_y
+            if distance_sq == 0:
+                continue
+            distance_sq += softening * softening
+            strength = grav_const * mass[j] / (distance_sq * math.sqrt(distance_sq))
+            sum_x += strength * diff_x
+            sum_y += strength * diff_y
+        out_x[row] = sum_x
+        out_y[row] = sum_y
+
+@parallel_jit
+def tree_accelerations(position_x, position_y, mass, key, order, grav_const, softening, theta, max_depth,
+                       node_mass, center_x, center_y, count, code, level, width, children, acceleration_x, acceleration_y):
+    # Same walk as BarnesHutEngine.accelerations, one body at a time down a
+    # stack of cells instead of every body one level at a time. The cells of
+    # all levels are in one list: `level` and `code` say where each one is,
+    # children holds four entries per cell (-1 for none). Bodies go in Morton
+    # order, so one after another open mostly the same cells (in cache), in
+    # chunks of 256 spread over the cores
+    last = level[len(level) - 1]
+    chunk = 256
+    for low in prange((len(mass) + chunk - 1) // chunk):
+        stack = np.empty(4 * (max_depth + 2), np.int64)
+        for body in range(low * chunk, min(low * chunk + chunk, len(mass))):
+            i = order[body]
+            sum_x = 0.0
+            sum_y = 0.0
+            stack[0] = 0
+            top = 1
+            while top > 0:
+                top -= 1
+                node = stack[top]
+                depth = level[node]
+                own = key[i] >> 2 * (max_depth - depth) == code[node]
+                weight = node_mass[node]
+                middle_x = center_x[node]
+                middle_y = center_y[node]
+                if depth == last and own:
+                    # The bottom cell a body is in, with the body's own mass taken out
+                    rest = weight - mass[i]
+                    if rest > 0:
+                        middle_x = (weight * middle_x - mass[i] * position_x[i]) / rest
+                        middle_y = (weight * middle_y - mass[i] * position_y[i]) / rest
+                    weight = rest
+                diff_x = middle_x - position_x[i]
+                diff_y = middle_y - position_y[i]
+                distance_sq = diff_x * diff_x + diff_y * diff_y
+                if depth == last:
+                    accept = weight > 0
+                else:
+                    accept = not own and (count[node] == 1 or width[depth] * width[depth] < theta * theta * distance_sq)
+                if accept and distance_sq > 0:
+                    distance_sq += softening * softening
+                    strength = grav_const * weight / (distance_sq * math.sqrt(distance_sq))
+                    sum_x += strength * diff_x
+                    sum_y += strength * diff_y
+                elif depth != last and count[node] > 1:
+                    for child in range(4):
+                        if children[4 * node + child] >= 0:
+                            stack[top] = children[4 * node + child]
+                            top += 1
+            acceleration_x[i] = sum_x
+            acceleration_y[i] = sum_y
+
+@jit
+def direct_accelerations_and_jerks(position_x, position_y, velocity_x, velocity_y, mass, grav_const, softening):
+    # Same as DirectEngine.accelerations_and_jerks. Each pair once (j > i):
+    # the pull and its rate of change on j are those on i turned around and
+    # scaled by m_i / m_j
+    number = len(mass)
+    acceleration_x = np.zeros(number)
+    acceleration_y = np.zeros(number)
+    jerk_x = np.zeros(number)
+    jerk_y = np.zeros(number)
+    for i in range(number):
+        for j in range(i + 1, number):
+            diff_x = position_x[j] - position_x[i]
+            diff_y = position_y[j] - position_y[i]
+            distance_sq = diff_x * diff_x + diff_y * diff_y
+            if distance_sq == 0:
+                continue
+            distance_sq += softening * softening
+            relative_x = velocity_x[j] - velocity_x[i]
+            relative_y = velocity_y[j] - velocity_y[i]
+            strength = grav_const / (distance_sq * math.sqrt(distance_sq))
+            approach = 3 * (diff_x * relative_x + diff_y * relative_y) / distance_sq
+            change_x = strength * (relative_x - approach * diff_x)
+            change_y = strength * (relative_y - approach * diff_y)
+            acceleration_x[i] += strength * mass[j] * diff_x
+            acceleration_y[i] += strength * mass[j] * diff_y
+            jerk_x[i] += mass[j] * change_x
+            jerk_y[i] += mass[j] * change_y
+            acceleration_x[j] -= strength * mass[i] * diff_x
+            acceleration_y[j] -= strength * mass[i] * diff_y
+            jerk_x[j] -= mass[i] * change_x
+            jerk_y[j] -= mass[i] * change_y
+    return acceleration_x, acceleration_y, jerk_x, jerk_y
+
+@jit
+def collide_rows(position_x, position_y, velocity_x, velocity_y, mass, radius, merged, start):
+    # Same as ParticleSet.collide_rows: row x merges with the first touching
+    # body after the last one it took in, until none is left or x is taken in
+    number = len(mass)
+    for x in range(start, number):
+        y = 0
+        while not merged[x] and y < number:
+            if y != x and not merged[y]:
+                diff_x = position_x[y] - position_x[x]
+                diff_y = position_y[y] - position_y[x]
+                if math.sqrt(diff_x * diff_x + diff_y * diff_y) <= radius[x] + radius[y]:
+                    # ParticleSet.merge
+                    momentum_x = mass[x] * velocity_x[x] + mass[y] * velocity_x[y]
+                    momentum_y = mass[x] * velocity_y[x] + mass[y] * velocity_y[y]
+                    if mass[x] > mass[y]:
+                        winner, loser = x, y
+                    else:
+                        winner, loser = y, x
+                    mass[winner] += mass[loser]
+                    velocity_x[winner] = momentum_x / mass[winner]
+                    velocity_y[winner] = momentum_y / mass[winner]
+                    merged[loser] = True
+                    radius[winner] = math.sqrt((mass[winner] / 10 ** 11) / math.pi)
+            y += 1
+
+@jit
+def grid_touching(position_x, position_y, radius, merged, buckets, cell_x, cell_y, packed, first, second):
+    # Touching pairs of live bodies (first < second, each pair once) from a
+    # grid like SpatialHash's, all in the arrays passed in. Cells are hashed
+    # into `buckets` (a power of two) and the bodies sorted by bucket, so the
+    # memory doesn't depend on how far apart the bodies are. Writes at most
+    # len(first) pairs and returns how many there are
+    number = len(position_x)
+    cell = 0.0
+    for i in range(number):
+        if not merged[i] and 2 * radius[i] > cell:
+            cell = 2 * radius[i]
+    if cell <= 0:
+        cell = 1.0
+    for i in range(number):
+        cell_x[i] = math.floor(position_x[i] / cell)
+        cell_y[i] = math.floor(position_y[i] / cell)
+        packed[i] = ((cell_x[i] * 73856093) ^ (cell_y[i] * 19349663)) & (buckets - 1)
+        packed[i] = packed[i] * number + i
+    packed.sort()
+
+    found = 0
+    for i in range(number):
+        if merged[i]:
+            continue
+        for near_y in range(cell_y[i] - 1, cell_y[i] + 2):
+            for near_x in range(cell_x[i] - 1, cell_x[i] + 2):
+                bucket = ((near_x * 73856093) ^ (near_y * 19349663)) & (buckets - 1)
+                # Other cells share the bucket, so bodies are checked for the cell too
+                entry = np.searchsorted(packed, bucket * number)
+                while entry < number and packed[entry] // number == bucket:
+                    j = packed[entry] % number
+                    entry += 1
+                    if j <= i or merged[j] or cell_x[j] != near_x or cell_y[j] != near_y:
+                        continue
+                    diff_x = position_x[j] - position_x[i]
+                    diff_y = position_y[j] - position_y[i]
+                    if math.sqrt(diff_x * diff_x + diff_y * diff_y) <= radius[i] + radius[j]:
+                        if found < len(first):
+                            first[found] = i
+                            second[found] = j
+                        found += 1
+    return found
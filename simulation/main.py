@@ -4,11 +4,79 @@ Gravity Simulation
 Last Edited: May 15th. 2017
 By Hiroya Gojo
 '''
-import math
+import argparse
+import gc
+import multiprocessing
 import os
 import pygame
 import random
-import sys
+import time
+
+import numpy as np
+
+import kernels
+from body import GRAV_CONST
+from collisions import SpatialHash, SweepAndPrune
+from engines import BarnesHutEngine, DirectEngine, FastMultipoleEngine, P3MEngine, ParallelEngine, ParticleMeshEngine, ThreadedEngine
+from integrators import AdaptiveTimestep, BlockTimestepIntegrator, EulerIntegrator, HermiteIntegrator, LeapfrogIntegrator
+from particles import ParticleSet
+
+# Launch options
+parser = argparse.ArgumentParser(description="Gravity Simulation")
+parser.add_argument("preset", nargs="?", help="preset file to open")
+parser.add_argument("--engine", choices=["direct", "parallel", "threaded", "barnes-hut", "particle-mesh", "p3m", "fmm"], default="direct",
+                    help="force engine (direct is exact, parallel/threaded is direct split over worker processes/threads, barnes-hut is O(N log N), particle-mesh is O(N) for dense clouds, "
+                         "p3m is particle-mesh with exact forces between close bodies, fmm is O(N) with tunable accuracy)")
+parser.add_argument("--workers", type=int, default=None,
+                    help="parallel/threaded: number of worker processes/threads (default one per core)")
+parser.add_argument("--theta", type=float, default=0.5,
+                    help="Barnes-Hut opening angle, smaller is more accurate (default 0.5)")
+parser.add_argument("--grid", type=int, default=256,
+                    help="particle-mesh/p3m cells across the screen width, more is more accurate (default 256)")
+parser.add_argument("--cutoff", type=float, default=8,
+                    help="p3m distance in grid cells below which pairs are summed exactly (default 8)")
+parser.add_argument("--order", type=int, default=6,
+                    help="fmm expansion order, higher is more accurate and slower (default 6)")
+parser.add_argument("--deterministic", action="store_true",
+                    help="p3m/fmm: add up pair forces in a fixed order, so results are the same to the last bit")
+parser.add_argument("--precision", choices=["double", "single"], default="double",
+                    help="direct/barnes-hut: work out the pair terms in float32 (single) for speed, positions and "
+                         "velocities stay float64 (default double)")
+parser.add_argument("--collisions", choices=["grid", "sweep", "brute"], default="grid",
+                    help="how touching bodies are found (grid only tests nearby pairs, sweep sorts bodies along x and "
+                         "suits clusters of very different sizes, brute tests every pair)")
+parser.add_argument("--merging", choices=["clusters", "pairs"], default="clusters",
+                    help="clusters merges each group of touching bodies into its heaviest at once, whatever order the "
+                         "bodies are in; pairs merges one pair at a time in the original loop order")
+parser.add_argument("--integrator", choices=["euler", "leapfrog", "block", "hermite"], default="euler",
+                    help="euler is the original first order scheme, leapfrog (kick-drift-kick) keeps orbits stable with "
+                         "much larger steps, block is leapfrog with each body's step cut down to what it needs, "
+                         "hermite is fourth order and the most accurate per step (direct engine only)")
+parser.add_argument("--dt", type=float, default=1,
+                    help="seconds of simulated time per physics step (default 1); leapfrog copes with 5 or more")
+parser.add_argument("--adaptive", action="store_true",
+                    help="pick dt before every step, small during close encounters and up to --dt otherwise")
+parser.add_argument("--accuracy", type=float, default=0.1,
+                    help="adaptive/block: fraction of an encounter's time scale a step may take, smaller is more accurate (default 0.1)")
+parser.add_argument("--softening", type=float, default=0,
+                    help="Plummer softening length in m: pulls between bodies closer than about this are weakened, "
+                         "so near misses don't need tiny steps (default 0, exact gravity)")
+parser.add_argument("--max-acceleration", type=float, default=None,
+                    help="cap on the size of each body's acceleration in m/s^2 (default no cap)")
+parser.add_argument("--no-jit", action="store_true",
+                    help="use the numpy code even when numba is installed (see kernels.py)")
+parser.add_argument("--budget", type=float, default=10,
+                    help="milliseconds of physics per frame; substeps that don't fit are dropped, so the simulation "
+                         "slows down instead of the frame rate (default 10)")
+args = parser.parse_args()
+if args.no_jit:
+    kernels.enabled = False
+if args.precision == "single" and args.engine not in ("direct", "barnes-hut"):
+    parser.error("--precision single only works with --engine direct or barnes-hut")
+if args.integrator == "hermite" and args.engine not in ("direct", "parallel", "threaded"):
+    parser.error("--integrator hermite needs the jerk, which only the direct sum engines work out")
+if args.engine == "parallel" and "fork" not in multiprocessing.get_all_start_methods():
+    parser.error("--engine parallel needs fork, which this platform doesn't have (use --engine threaded)")
 
 # Background Colors
 BLACK = (0, 0, 0)
@@ -18,9 +86,31 @@ DARK_RED = (156, 43, 43)
 LIGHT_GRAY = (40, 40, 40)
 DARK_GRAY = (15, 15, 15)
 
+# Size of the window and the world
+size = (1280, 720)
+
+# Force engine
+limits = dict(softening=args.softening, max_acceleration=args.max_acceleration)
+if args.engine == "parallel":
+    engine = ParallelEngine(args.workers, **limits)
+    # Forks the workers now, before pygame starts (forking with the window
+    # open is unsafe on macOS)
+    engine.start_pool()
+elif args.engine == "threaded":
+    engine = ThreadedEngine(args.workers, **limits)
+elif args.engine == "barnes-hut":
+    engine = BarnesHutEngine(args.theta, precision=args.precision, **limits)
+elif args.engine == "particle-mesh":
+    engine = ParticleMeshEngine(size, args.grid, **limits)
+elif args.engine == "p3m":
+    engine = P3MEngine(size, args.grid, args.cutoff, deterministic=args.deterministic, **limits)
+elif args.engine == "fmm":
+    engine = FastMultipoleEngine(args.order, deterministic=args.deterministic, **limits)
+else:
+    engine = DirectEngine(precision=args.precision, **limits)
+
 # Initialize for program
 pygame.init()
-size = (1280, 720)
 screen = pygame.display.set_mode(size)
 pygame.display.set_caption("Gravity Simulation - Hiroya")
 
@@ -54,13 +144,33 @@ clock = pygame.time.Clock()
 random.seed()
 
 # Create objects and variable declarations
-objects = []
+objects = ParticleSet()
 file_position_x = []
 file_position_y = []
 number_of_objects = 15
 start_mass = 50
 game_speed = 1
 
+# Fixed timestep: at speed 1 a second of simulated time passes every 1/60 s
+# of wall time, in steps of dt. accumulator holds the simulated time owed
+# so far, sim_rate is how much was actually simulated per second of wall time
+accumulator = 0.0
+last_frame_time = time.perf_counter()
+rate_sim_time = 0.0
+rate_steps = 0
+rate_time = 0.0
+sim_rate = 0.0
+step_rate = 0.0
+dt = args.dt
+
+# Positions (x array, y array, color array) of every substep since the last
+# drawn frame, for the path
+trail = []
+
+# Id of the body clicked on, None for none (ids stay the same when merged
+# bodies are taken out of the arrays, indexes don't)
+selected_id = None
+
 # Create border
 border_thickness = 5
 border_right = (0, 0, border_thickness, size[1])
@@ -84,8 +194,33 @@ last_saved_time = -1000
 last_error_time = -1000
 current_time = 0
 
-# Constant
-GRAV_CONST = 6.67408 * (10 ** (-11))
+# Collision broad phase (None tests every pair)
+if args.collisions == "grid":
+    broad_phase = SpatialHash
+elif args.collisions == "sweep":
+    # Kept for the whole run, it carries the sort order from step to step
+    broad_phase = SweepAndPrune()
+else:
+    broad_phase = None
+
+# Integrator
+if args.integrator == "leapfrog":
+    integrator = LeapfrogIntegrator()
+elif args.integrator == "block":
+    integrator = BlockTimestepIntegrator(args.accuracy)
+elif args.integrator == "hermite":
+    integrator = HermiteIntegrator()
+else:
+    integrator = EulerIntegrator()
+
+# Step size, fixed at --dt unless it is picked every step. A picked dt is
+# worked out right after the step before it and kept until used (across
+# frames too), dt_picked is False while it has to be worked out again
+if args.adaptive:
+    timestep = AdaptiveTimestep(args.dt, args.accuracy, **limits)
+else:
+    timestep = None
+dt_picked = False
 
 # Gets data from file
 def read_from_file(str_name):
@@ -116,138 +251,77 @@ def read_from_file(str_name):
     return False
  
 # Checks for file to open
-if len(sys.argv) > 1:
-    file_to_open = sys.argv[1]
-    read_from_file(file_to_open)
-
-# class object
-class Object:
-    def __init__ (self, mass, position_x, position_y, color):
-        # Initialize mass and position 
-        self.mass = mass
-        self.merged = False
-        self.selected = False
-        self.store_force_x = 0
-        self.store_force_y = 0
-                
-        self.color = color
-
-        self.position_x = position_x
-        self.position_y = position_y
-
-        self.acceleration_x = 0
-        self.acceleration_y = 0
-
-        self.velocity_x = 0
-        self.velocity_y = 0
-
-    def calculate_radius(self):
-        # Radius is dependent on mass
-        # Assumes one unit of mass (1 * 10^11 kg) is equal to one m^2
-        self.radius = math.sqrt((self.mass / 10 ** 11) / math.pi)
-
-    def calculate_new_position(self):
-        # Velocity is change in position
-        self.position_x += self.velocity_x
-        self.position_y += self.velocity_y
-
-        if border:
-            # Check each border for collision
-            if self.position_x + self.radius > size[0]:
-                # First move the object (to prevent repeated collision)
-                self.position_x = size[0] - self.radius
-                # Velocity is reversed
-                self.velocity_x *= -1
-            if self.position_x - self.radius < 0:
-                self.position_x = self.radius
-                self.velocity_x *= -1
-            if self.position_y + self.radius > size[1]:
-                self.position_y = size[1] - self.radius
-                self.velocity_y *= -1
-            if self.position_y - self.radius < 0:
-                self.position_y = self.radius
-                self.velocity_y *= -1
-
-    def calculate_new_velocity(self, obj):
-        # Find angle and force in x and y
-        angle = self.calculate_angle(obj)
-        force = self.calculate_force(obj)
-        force_x = force * math.cos(angle)
-        force_y = force * math.sin(angle)
-
-        # Adds the force to the stored force
-        self.store_force_x += force_x
-        self.store_force_y += force_y
-
-        # Newton's second law
-        self.acceleration_x = force_x / self.mass
-        self.acceleration_y = force_y / self.mass
-
-        # Acceleration is change in velocity
-        self.velocity_x += self.acceleration_x
-        self.velocity_y += self.acceleration_y
-
-    def calculate_angle(self, obj):
-        # Use trig to get angle between two objects
-        diff_x = obj.position_x - self.position_x
-        diff_y = obj.position_y - self.position_y
-
-        if diff_x != 0:
-            angle = math.atan(diff_y / diff_x)
-        else:
-            angle = 0
-
-        if diff_x < 0:
-            angle += math.pi
-        return angle
-
-    def calculate_force(self, obj):
-        # Equation for gravity (using big G)
-        distance = math.sqrt((self.position_x - obj.position_x)**2 + (self.position_y - obj.position_y)**2)
-        return GRAV_CONST * (self.mass * obj.mass)/ (distance**2)
-
-    def collision(self, obj):
-        # Gets distance beteween two objects
-        difference_x = self.position_x - obj.position_x
-        difference_y = self.position_y - obj.position_y
-        position = math.sqrt(difference_x ** 2 + difference_y ** 2)
-
-        # If the distance between the two is less than the two object's radii, they collided
-        if position <= (self.radius + obj.radius):
-            momentum_x = self.mass * self.velocity_x + obj.mass * obj.velocity_x
-            momentum_y = self.mass * self.velocity_y + obj.mass * obj.velocity_y
-
-            # Merges to the larger mass
-            if self.mass > obj.mass:
-                # Using conservation of momentum and assumes perfectly inelastic collision
-                self.mass += obj.mass
-                self.velocity_x = momentum_x / self.mass
-                self.velocity_y = momentum_y / self.mass
-
-                # Merged objects disappear
-                obj.merged = True
-
-                # Recalculates radius based on new mass
-                self.calculate_radius()
-            else:
-                obj.mass += self.mass
-                obj.velocity_x = momentum_x / obj.mass
-                obj.velocity_y = momentum_y / obj.mass
-                self.merged = True
-                obj.calculate_radius()
-
-
-    def draw_object(self):
-        if not self.merged:
+if args.preset:
+    read_from_file(args.preset)
+
+def selected_index():
+    # Where the selected body is in the arrays now, None if nothing is
+    # selected or it has merged into another body
+    if selected_id is None:
+        return None
+    index = objects.index_of(selected_id)
+    if index is None or objects.merged[index]:
+        return None
+    return index
+
+def draw_objects(objects):
+    # Reads the arrays once instead of going through a Particle per body
+    position_x = objects.position_x.astype(int).tolist()
+    position_y = objects.position_y.astype(int).tolist()
+    radius = objects.radius.astype(int).tolist()
+    colors = [tuple(color) for color in objects.color.tolist()]
+    merged = objects.merged.tolist()
+    selected = selected_index()
+    for i in range(len(objects)):
+        if not merged[i]:
             # If an object is selected, draw an outline around them
-            if self.selected:
-                pygame.draw.circle(screen, DARK_RED, [int(self.position_x), int(self.position_y)], int(self.radius) + 4)
+            if i == selected:
+                pygame.draw.circle(screen, DARK_RED, [position_x[i], position_y[i]], radius[i] + 4)
 
             # Draw objects. If/else for diff color modes
             if draw_color:
-                pygame.draw.circle(screen, self.color, [int(self.position_x), int(self.position_y)], int(self.radius))
+                pygame.draw.circle(screen, colors[i], [position_x[i], position_y[i]], radius[i])
             else:
-                pygame.draw.circle(screen, WHITE, [int(self.position_x), int(self.position_y)], int(self.radius))
+                pygame.draw.circle(screen, WHITE, [position_x[i], position_y[i]], radius[i])
+
+def physics_step(dt):
+    # Checks for collision and merges touching bodies, then takes the merged ones out
+    if args.merging == "clusters":
+        objects.collide_clusters(broad_phase)
+    else:
+        objects.collide(broad_phase)
+    objects.remove_merged()
+
+    # Calculates new velocity based on force of gravity (all pairs at once)
+    # and position based on velocity
+    integrator.step(objects, engine, GRAV_CONST, dt, border, size)
+
+    # Keeps every substep's positions for the path
+    if draw_path:
+        record_trail(objects)
+
+def record_trail(objects):
+    # Called every substep while the path is on. Only copies the positions,
+    # they are drawn with the next frame
+    live = ~objects.merged
+    trail.append((objects.position_x[live], objects.position_y[live], objects.color[live]))
+
+def draw_trail():
+    # Puts a pixel at every recorded position in one go, straight into the screen's pixels
+    if not trail:
+        return
+    position_x = np.concatenate([x for x, y, color in trail]).astype(int)
+    position_y = np.concatenate([y for x, y, color in trail]).astype(int)
+    colors = np.concatenate([color for x, y, color in trail])
+    del trail[:]
+    inside = (position_x >= 0) & (position_x < size[0]) & (position_y >= 0) & (position_y < size[1])
+    pixels = pygame.surfarray.pixels3d(screen)
+    if draw_color:
+        pixels[position_x[inside], position_y[inside]] = colors[inside]
+    else:
+        pixels[position_x[inside], position_y[inside]] = WHITE
+    # The screen stays locked while the pixel array exists
+    del pixels
 
 def open_preset(number):
     global last_time
@@ -288,10 +362,17 @@ def init_objects():
     global file_position_y
     global file_open
     global objects
+    global dt_picked
+    global selected_id
+
+    # New bodies need a new dt, and nothing is selected
+    dt_picked = False
+    selected_id = None
 
     # Resets screen regardless of flag draw_path
     screen.fill(BLACK)
-    del objects[:]
+    del trail[:]
+    objects = ParticleSet(number_of_objects)
     if not file_open:
         file_position_x[:] = []
         file_position_y[:] = []
@@ -311,15 +392,24 @@ def init_objects():
             file_position_y.append(position_y)
         # Randomized color
         color = (random.randint(0, 255), random.randint(0, 255), random.randint(0, 255))
-        # Add the object and calculate radius
-        objects.append(Object(mass, position_x, position_y, color))
-        objects[i].calculate_radius()
+        # Add the object
+        objects.mass[i] = mass
+        objects.position_x[i] = position_x
+        objects.position_y[i] = position_y
+        objects.color[i] = color
+    # Radius is dependent on mass
+    objects.calculate_radius()
     # File open only works on first run
     file_open = False
 
 # Starts off
 init_objects()
 
+# Everything made while starting up (pygame, numpy, the engines) lives for
+# the whole run. Freezing it keeps the garbage collector from walking all
+# of it again on every full collection (a visible hitch in the frame time)
+gc.freeze()
+
 # Main loop
 while not done:
     # Update time
@@ -342,6 +432,7 @@ while not done:
     elif pressed[pygame.K_z] and current_time > delay + last_time:
         last_time = current_time
         draw_path = not draw_path 
+        del trail[:]
 
     # Border
     elif pressed[pygame.K_x] and current_time > delay + last_time:
@@ -433,53 +524,62 @@ while not done:
 
     # Check if player clicked on an object
     if pygame.mouse.get_pressed()[0]:
-        # To check whether to deselect item
-        for i in objects:
-            # Deselect all other objects
-            i.selected = False
-            # Find distance between mouse and object
-            mouse_pos = pygame.mouse.get_pos()
-            distance = math.sqrt((mouse_pos[0] - i.position_x)**2 + (mouse_pos[1] - i.position_y)**2)
-            # If the distance is smaller than the radius, the mouse is in the object and is selected
-            if i.radius > distance:
-                # Current object is selected
-                i.selected = True
-                break
+        # Deselect everything, then select the first object the mouse is in
+        # (distance to the mouse smaller than the radius)
+        mouse_pos = pygame.mouse.get_pos()
+        distance = np.hypot(mouse_pos[0] - objects.position_x, mouse_pos[1] - objects.position_y)
+        hit = np.flatnonzero(objects.radius > distance)
+        selected_id = objects.id[hit[0]] if len(hit) else None
+
+    # Wall time since the last frame (capped, so a stall doesn't have to be caught up)
+    frame_time = time.perf_counter()
+    elapsed = min(frame_time - last_frame_time, 0.25)
+    last_frame_time = frame_time
 
     # If paused, don't need to run code
     if not pause:
-        # Run multiple times for larger game_speed
-        for num in range(game_speed):
-            # Checks for collision and deletes y if applicable
-            for x in objects:
-                for y in objects:
-                    if x != y and not x.merged and not y.merged:
-                        x.collision(y)
-
-            # Zeroes out acceleration and old gravitational force
-            for x in objects:
-                x.acceleration_x = 0
-                x.acceleration_y = 0
-                x.store_force_x = 0
-                x.store_force_y = 0
-
-            # Calculates new velocity based on force of gravity
-            for x in objects:
-                for y in objects:
-                    if x != y and not x.merged and not y.merged:
-                        x.calculate_new_velocity(y)
-
-            # Calculates position based on velocity
-            for x in objects:
-                x.calculate_new_position()
-
-            # Fill screen
-            if not draw_path:
-                screen.fill(BLACK)
-
-            # Draw
-            for i in objects:
-                i.draw_object()
+        # game_speed seconds are owed for every 1/60 s. Runs a step for each
+        # whole dt owed (none in a frame that owes less, as at low speeds),
+        # until the physics budget for this frame is used up. The budget is
+        # checked after each step, so once a step is owed at least one runs,
+        # and the rest is dropped so a heavy scene runs slower instead of lagging
+        accumulator += elapsed * 60 * game_speed
+        physics_start = time.perf_counter()
+        while True:
+            if timestep is not None and not dt_picked:
+                dt = timestep.choose(objects, GRAV_CONST)
+                dt_picked = True
+            if accumulator < dt:
+                break
+            physics_step(dt)
+            accumulator -= dt
+            rate_sim_time += dt
+            rate_steps += 1
+            # dt for the next step, inside the budget (the pass that only
+            # finds too little time owed doesn't pick it again)
+            if timestep is not None:
+                dt = timestep.choose(objects, GRAV_CONST)
+            if time.perf_counter() - physics_start > args.budget / 1000:
+                accumulator %= dt
+                break
+
+        # Fill screen, or draw the path since the last frame over the old one
+        if not draw_path:
+            screen.fill(BLACK)
+        else:
+            draw_trail()
+
+        # Draw once per frame, however many substeps ran
+        draw_objects(objects)
+
+    # Simulated seconds per second of wall time, over the last half second
+    rate_time += elapsed
+    if rate_time >= 0.5:
+        sim_rate = rate_sim_time / rate_time
+        step_rate = rate_steps / rate_time
+        rate_sim_time = 0.0
+        rate_steps = 0
+        rate_time = 0.0
 
     if not hide_controls:
         # Rectangle for top bar
@@ -487,36 +587,39 @@ while not done:
 
         # Draw boxes to clear the text
         pygame.draw.rect(screen, DARK_GRAY, (0, 90, 80, 30))
+        pygame.draw.rect(screen, DARK_GRAY, (0, 120, 160, 35))
         pygame.draw.rect(screen, DARK_GRAY, (size[0] - 140, 40, 140, 40))
 
-        # If an object is selected, display its information
-        for i in objects:
-            if i.selected and not i.merged:
-                object_information_x = "X  Position: " + str(round(i.position_x, 2))
-                object_information_y = "Y  Position: " + str(size[1] - round(i.position_y, 2))
-                object_information_vel_x = "X  Velocity: "  + str(round(i.velocity_x, 3)) + "m/s"
-                object_information_vel_y = "Y  Velocity: "  + str(round(-i.velocity_y, 3)) + "m/s"
-                object_information_acc_x = "X  Acceleration: " + str(round(i.acceleration_x, 5)) + "m/s^2"
-                object_information_acc_y = "Y  Acceleration: " + str(round(-i.acceleration_y, 5)) + "m/s^2"
-                object_information_force_x = "X  Force: " + str('%.3e' % i.store_force_x) + "N"
-                object_information_force_y = "Y  Force: " + str('%.3e' % -i.store_force_y) + "N"
-                # Display the text
-                text_display_x = text_font_small.render(object_information_x, False, WHITE)
-                text_display_y = text_font_small.render(object_information_y, False, WHITE)
-                text_display_vel_x = text_font_small.render(object_information_vel_x, False, WHITE)
-                text_display_vel_y = text_font_small.render(object_information_vel_y, False, WHITE)
-                text_display_acc_x = text_font_small.render(object_information_acc_x, False, WHITE)
-                text_display_acc_y = text_font_small.render(object_information_acc_y, False, WHITE)
-                text_display_force_x = text_font_small.render(object_information_force_x, False, WHITE)
-                text_display_force_y = text_font_small.render(object_information_force_y, False, WHITE)
-                screen.blit(text_display_x, (600, 4))
-                screen.blit(text_display_y, (600, 25))
-                screen.blit(text_display_vel_x, (760, 4))
-                screen.blit(text_display_vel_y, (760, 25))
-                screen.blit(text_display_acc_x, (900, 4))
-                screen.blit(text_display_acc_y, (900, 25))
-                screen.blit(text_display_force_x, (1100, 4))
-                screen.blit(text_display_force_y, (1100, 25))
+        # If an object is selected, display its information. Found by its id,
+        # so only the selected body is looked at through a Particle
+        selected = selected_index()
+        if selected is not None:
+            i = objects[selected]
+            object_information_x = "X  Position: " + str(round(i.position_x, 2))
+            object_information_y = "Y  Position: " + str(size[1] - round(i.position_y, 2))
+            object_information_vel_x = "X  Velocity: "  + str(round(i.velocity_x, 3)) + "m/s"
+            object_information_vel_y = "Y  Velocity: "  + str(round(-i.velocity_y, 3)) + "m/s"
+            object_information_acc_x = "X  Acceleration: " + str(round(i.acceleration_x, 5)) + "m/s^2"
+            object_information_acc_y = "Y  Acceleration: " + str(round(-i.acceleration_y, 5)) + "m/s^2"
+            object_information_force_x = "X  Force: " + str('%.3e' % i.store_force_x) + "N"
+            object_information_force_y = "Y  Force: " + str('%.3e' % -i.store_force_y) + "N"
+            # Display the text
+            text_display_x = text_font_small.render(object_information_x, False, WHITE)
+            text_display_y = text_font_small.render(object_information_y, False, WHITE)
+            text_display_vel_x = text_font_small.render(object_information_vel_x, False, WHITE)
+            text_display_vel_y = text_font_small.render(object_information_vel_y, False, WHITE)
+            text_display_acc_x = text_font_small.render(object_information_acc_x, False, WHITE)
+            text_display_acc_y = text_font_small.render(object_information_acc_y, False, WHITE)
+            text_display_force_x = text_font_small.render(object_information_force_x, False, WHITE)
+            text_display_force_y = text_font_small.render(object_information_force_y, False, WHITE)
+            screen.blit(text_display_x, (600, 4))
+            screen.blit(text_display_y, (600, 25))
+            screen.blit(text_display_vel_x, (760, 4))
+            screen.blit(text_display_vel_y, (760, 25))
+            screen.blit(text_display_acc_x, (900, 4))
+            screen.blit(text_display_acc_y, (900, 25))
+            screen.blit(text_display_force_x, (1100, 4))
+            screen.blit(text_display_force_y, (1100, 25))
 
         # Game speed change
         text_speed = text_font.render("Speed: " + str(game_speed) + "x", False, WHITE)
@@ -525,6 +628,12 @@ while not done:
         screen.blit(text_a, (10, 55))
         screen.blit(text_p, (10, 70))
 
+        # Achieved speed, below game_speed when the physics budget runs out
+        text_rate = text_font_small.render("Sim/wall time: " + str(round(sim_rate, 1)) + " (" + str(round(sim_rate / 60, 2)) + "x)", False, GRAY)
+        screen.blit(text_rate, (10, 122))
+        text_dt = text_font_small.render("dt: " + str('%.3g' % dt) + "s, " + str(round(step_rate)) + " steps/s", False, GRAY)
+        screen.blit(text_dt, (10, 137))
+
         # Mass Change
         text_mass = text_font.render("Init Mass: " + str(start_mass) + "*10^11 kg", False, WHITE)
         screen.blit(text_mass, (190, 14))
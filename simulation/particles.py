@@ -0,0 +1,256 @@
+'''
+Particle Set
+----------------------------
+All bodies of the simulation stored as one contiguous numpy array per
+property (structure of arrays) instead of one Object per body. The force
+engines read the position and mass arrays as they are.
+'''
+import numpy as np
+
+import kernels
+from collisions import merge_clusters, resolve
+from engines import DirectEngine
+from workspace import Workspace
+
+# Per-body arrays of a ParticleSet that a Particle exposes as attributes
+FIELDS = ("position_x", "position_y", "velocity_x", "velocity_y", "acceleration_x", "acceleration_y",
+          "mass", "radius", "merged", "id")
+
+# Every per-body array, in the order they are compacted
+ARRAYS = FIELDS + ("color",)
+
+# One body of a ParticleSet, looked at through the Object attribute names
+# (for the HUD, selection and drawing code). Reads and writes go straight
+# to the set's arrays
+class Particle:
+    __slots__ = ("particles", "index")
+
+    def __init__(self, particles, index):
+        object.__setattr__(self, "particles", particles)
+        object.__setattr__(self, "index", index)
+
+    def __getattr__(self, name):
+        if name in FIELDS:
+            return getattr(self.particles, name)[self.index].item()
+        raise AttributeError(name)
+
+    def __setattr__(self, name, value):
+        if name not in FIELDS or name == "id":
+            raise AttributeError(name)
+        getattr(self.particles, name)[self.index] = value
+
+    def __eq__(self, other):
+        return isinstance(other, Particle) and other.particles is self.particles and other.index == self.index
+
+    def __hash__(self):
+        return hash((id(self.particles), self.index))
+
+    @property
+    def color(self):
+        return tuple(self.particles.color[self.index].tolist())
+
+    @property
+    def store_force_x(self):
+        # Total force from the last step (Newton's second law backwards)
+        return self.acceleration_x * self.mass
+
+    @property
+    def store_force_y(self):
+        return self.acceleration_y * self.mass
+
+class ParticleSet:
+    def __init__(self, number=0):
+        self.position_x = np.zeros(number)
+        self.position_y = np.zeros(number)
+        self.velocity_x = np.zeros(number)
+        self.velocity_y = np.zeros(number)
+        self.acceleration_x = np.zeros(number)
+        self.acceleration_y = np.zeros(number)
+        self.mass = np.zeros(number)
+        self.radius = np.zeros(number)
+        self.color = np.zeros((number, 3), dtype=np.uint8)
+        self.merged = np.zeros(number, dtype=bool)
+        # Stable number of each body. Indexes shift when merged bodies are
+        # removed, ids don't (and stay sorted, see remove_merged)
+        self.id = np.arange(number)
+        # Scratch arrays for the step (see workspace.py), so that a step
+        # without merges or border hits makes no new arrays
+        self.workspace = Workspace()
+
+    @classmethod
+    def from_objects(cls, objects):
+        # Copies a list of Objects (e.g. from the benchmarks) into a new set
+        particles = cls(len(objects))
+        for i, x in enumerate(objects):
+            particles.position_x[i] = x.position_x
+            particles.position_y[i] = x.position_y
+            particles.velocity_x[i] = x.velocity_x
+            particles.velocity_y[i] = x.velocity_y
+            particles.mass[i] = x.mass
+            particles.color[i] = x.color
+            particles.merged[i] = x.merged
+        particles.calculate_radius()
+        return particles
+
+    def __len__(self):
+        return len(self.mass)
+
+    def __getitem__(self, index):
+        return Particle(self, index)
+
+    def __iter__(self):
+        for index in range(len(self)):
+            yield Particle(self, index)
+
+    def index_of(self, body_id):
+        # Current index of the body with this id, or None once it has merged away
+        index = np.searchsorted(self.id, body_id)
+        if index < len(self.id) and self.id[index] == body_id:
+            return int(index)
+        return None
+
+    def remove_merged(self, threshold=0.0):
+        # Drops merged bodies so later steps (collisions, gravity, moving,
+        # drawing) don't keep skipping over them. Only runs once more than
+        # `threshold` of the set is dead, so it can be batched up.
+        # Keeps the order of the live bodies, which keeps the ids sorted and
+        # the collision order the same
+        dead = np.count_nonzero(self.merged)
+        if dead == 0 or dead <= threshold * len(self):
+            return
+        live = ~self.merged
+        for name in ARRAYS:
+            setattr(self, name, getattr(self, name)[live])
+
+    def calculate_radius(self):
+        # Radius is dependent on mass
+        # Assumes one unit of mass (1 * 10^11 kg) is equal to one m^2
+        self.radius[:] = np.sqrt((self.mass / 10 ** 11) / np.pi)
+
+    def calculate_new_position(self, border, size, dt=1.0):
+        # Velocity is change in position
+        change = self.workspace.get("change", len(self))
+        self.position_x += np.multiply(self.velocity_x, dt, out=change)
+        self.position_y += np.multiply(self.velocity_y, dt, out=change)
+
+        if border:
+            self.bounce(size)
+
+    def bounce(self, size):
+        # Check each border for collision: move the body back inside
+        # (to prevent repeated collision) and reverse its velocity.
+        # The tests go through scratch arrays, and bodies are only picked out
+        # on the (rare) steps where one is over a border
+        edge = self.workspace.get("edge", len(self))
+        hit = self.workspace.get("hit", len(self), bool)
+        if np.greater(np.add(self.position_x, self.radius, out=edge), size[0], out=hit).any():
+            self.position_x[hit] = size[0] - self.radius[hit]
+            self.velocity_x[hit] *= -1
+        if np.less(np.subtract(self.position_x, self.radius, out=edge), 0, out=hit).any():
+            self.position_x[hit] = self.radius[hit]
+            self.velocity_x[hit] *= -1
+        if np.greater(np.add(self.position_y, self.radius, out=edge), size[1], out=hit).any():
+            self.position_y[hit] = size[1] - self.radius[hit]
+            self.velocity_y[hit] *= -1
+        if np.less(np.subtract(self.position_y, self.radius, out=edge), 0, out=hit).any():
+            self.position_y[hit] = self.radius[hit]
+            self.velocity_y[hit] *= -1
+
+    def apply_gravity(self, engine, grav_const, dt=1.0):
+        # Same effect as calling x.calculate_new_velocity(y) for every pair of live bodies
+        self.calculate_acceleration(engine, grav_const)
+        self.kick(dt)
+
+    def calculate_acceleration(self, engine, grav_const):
+        # Acceleration of every live body from the pull of all the others
+        if self.merged.any():
+            live = np.flatnonzero(~self.merged)
+            acceleration_x, acceleration_y = engine.accelerations(self.position_x[live], self.position_y[live], self.mass[live], grav_const)
+            self.acceleration_x[:] = 0
+            self.acceleration_y[:] = 0
+            self.acceleration_x[live] = acceleration_x
+            self.acceleration_y[live] = acceleration_y
+        elif isinstance(engine, DirectEngine):
+            # Nothing merged yet, so the arrays go to the engine as they are
+            # (and the direct engines write straight into ours)
+            engine.accelerations(self.position_x, self.position_y, self.mass, grav_const,
+                                 out=(self.acceleration_x, self.acceleration_y))
+        elif len(self):
+            self.acceleration_x[:], self.acceleration_y[:] = engine.accelerations(self.position_x, self.position_y, self.mass, grav_const)
+
+    def kick(self, dt):
+        # Acceleration is change in velocity
+        change = self.workspace.get("change", len(self))
+        self.velocity_x += np.multiply(self.acceleration_x, dt, out=change)
+        self.velocity_y += np.multiply(self.acceleration_y, dt, out=change)
+
+    def total_energy(self, grav_const, softening=0.0):
+        # Kinetic plus potential energy of the live bodies (every pair, so
+        # only for checking integrators on small sets). softening as in the
+        # engines, so the energy matches the softened pull
+        live = ~self.merged
+        mass = self.mass[live]
+        kinetic = 0.5 * np.sum(mass * (self.velocity_x[live] ** 2 + self.velocity_y[live] ** 2))
+        diff_x = self.position_x[live, None] - self.position_x[live]
+        diff_y = self.position_y[live, None] - self.position_y[live]
+        distance = np.sqrt(diff_x ** 2 + diff_y ** 2 + softening ** 2)
+        first, second = np.triu_indices(len(mass), 1)
+        potential = -grav_const * np.sum(mass[first] * mass[second] / distance[first, second])
+        return kinetic + potential
+
+    def merge(self, first, second):
+        # Perfectly inelastic collision, the heavier body takes the other in
+        # (same rules as Object.collision)
+        momentum_x = self.mass[first] * self.velocity_x[first] + self.mass[second] * self.velocity_x[second]
+        momentum_y = self.mass[first] * self.velocity_y[first] + self.mass[second] * self.velocity_y[second]
+        if self.mass[first] > self.mass[second]:
+            winner, loser = first, second
+        else:
+            winner, loser = second, first
+
+        # Using conservation of momentum
+        self.mass[winner] += self.mass[loser]
+        self.velocity_x[winner] = momentum_x / self.mass[winner]
+        self.velocity_y[winner] = momentum_y / self.mass[winner]
+
+        # Merged bodies disappear, the winner grows
+        self.merged[loser] = True
+        self.radius[winner] = np.sqrt((self.mass[winner] / 10 ** 11) / np.pi)
+        return winner
+
+    def collide(self, broad_phase=None):
+        # Merges every pair of touching bodies, in the same order as the old
+        # nested "for x in objects: for y in objects: x.collision(y)" loop.
+        # With a broad phase (see collisions.py) only nearby pairs are tested
+        if broad_phase is not None:
+            resolve(self, broad_phase)
+            return
+
+        self.collide_rows()
+
+    def collide_rows(self, start=0):
+        # Brute force from row `start` on: each row is one numpy pass over every
+        # body; a merge grows a radius, so the rest of the row is checked again
+        if kernels.enabled:
+            kernels.collide_rows(self.position_x, self.position_y, self.velocity_x, self.velocity_y,
+                                 self.mass, self.radius, self.merged, start)
+            return
+        for x in range(start, len(self)):
+            y = -1
+            while not self.merged[x]:
+                diff_x = self.position_x - self.position_x[x]
+                diff_y = self.position_y - self.position_y[x]
+                touching = np.sqrt(diff_x ** 2 + diff_y ** 2) <= self.radius[x] + self.radius
+                touching &= ~self.merged
+                touching[x] = False
+                touching[:y + 1] = False
+                found = np.flatnonzero(touching)
+                if len(found) == 0:
+                    break
+                y = found[0]
+                self.merge(x, y)
+
+    def collide_clusters(self, broad_phase=None):
+        # Merges each group of touching bodies into its heaviest one at once,
+        # whatever order the bodies are in (see collisions.merge_clusters)
+        merge_clusters(self, broad_phase)
@@ -0,0 +1,30 @@
+'''
+Workspace
+----------------------------
+Scratch arrays kept from step to step, so a physics step works in the same
+memory every time instead of making new arrays (which costs allocator time
+and, for the Python objects around them, garbage collector pauses).
+'''
+import numpy as np
+
+class Workspace:
+    def __init__(self):
+        self.arrays = {}
+
+    def get(self, name, size, dtype=np.float64):
+        # The first `size` entries of the array kept under `name`, holding
+        # whatever was left in them. Grown to twice the size asked for when
+        # too small, so it settles after a few steps
+        array = self.arrays.get(name)
+        if array is None or len(array) < size or array.dtype != dtype:
+            array = np.empty(2 * size, dtype)
+            self.arrays[name] = array
+        return array[:size]
+
+    def indexes(self, size):
+        # 0, 1, ..., size - 1
+        array = self.arrays.get("indexes")
+        if array is None or len(array) < size:
+            array = np.arange(2 * size)
+            self.arrays["indexes"] = array
+        return array[:size]